@@ -1,14 +1,32 @@
 from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import json
+import os
 from pathlib import Path
-from typing import Any
+import tempfile
+import threading
+import time
+from typing import Any, Callable
 import toml
 
+import openai
 from openai import OpenAI
 
 from stories import render_template, resolve_file
 from stories.assistant import AssistantsAPI, generate_audio, generate_image, RunError
+from stories.cassette import Cassette
+from stories.fuzzy import NameIndex
+from stories.governor import governor
+from stories.jobs import JobQueue
+from stories.prompts import PromptQueue
+from stories.routing import Router
+from stories.transport import Transport
+from stories.usage import UsageLedger
+from stories.warm import WarmThreads
+from stories.schema import ValidationError, compile_tools
 
 class Storage:
     ''' A generic base class for storing collections of objects. '''
@@ -51,10 +69,11 @@ class Storage:
 
 class Entity:
 
-    def __init__(self, type: str, name: str, desc: str) -> None:
+    def __init__(self, type: str, name: str, desc: str, aliases: list[str] = None) -> None:
         self.type = type
         self.name = name
         self.desc = desc
+        self.aliases = aliases or []
 
     def __str__(self):
         return f'{self.name} ({self.type}) | {self.desc}'
@@ -65,12 +84,44 @@ class Entity:
             'type': self.type,
             'name': self.name,
             'desc': self.desc,
+            'aliases': self.aliases,
         }
 
 class Entities(Storage):
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.index = NameIndex()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.index.add(key, value.name, *value.aliases)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.index.remove(key)
     
     def add(self, entity: Entity):
-        self.records[entity.name] = entity
+        self[entity.name] = entity
+
+    def resolve(self, name: str) -> str | None:
+        ''' Returns the key of the entity with this name, ignoring case, accents and punctuation. '''
+        if name in self.records:
+            return name
+        return self.index.exact(name)
+
+    def find(self, name: str) -> Entity | None:
+        ''' Returns the entity with the given name, or the closest match by name or alias. '''
+        if name in self.records:
+            return self.records[name]
+        if (key := self.index.best(name)) is not None:
+            return self.records[key]
+        return None
+
+    def candidates(self, name: str, limit: int = 5) -> list[Entity]:
+        ''' Returns close matches to suggest for a name that wasn't found. Weak matches are
+        left out, so the assistant isn't steered toward unrelated entities. '''
+        return [self.records[key] for key, _ in self.index.candidates(name, limit, min_score=self.index.threshold / 2)]
 
     def add_many(self, *entities: Entity):
         for entity in entities:
@@ -82,21 +133,27 @@ class Entities(Storage):
             self.add(Entity(**entity))
 
 class Asset:
-    def __init__(self, message_id: str, name: str, type: str, data: bytes = None, base: str = 'assets'):
+    def __init__(self, message_id: str, name: str, type: str, data: bytes = None, base: str = 'assets', version: int = None):
         self.message_id = message_id
         self.name = name
         self.type = type
         self.base = base
         self.data = data
+        # Set whenever the file is written, so readers can tell a rewritten file without checking it.
+        self.version = version
     
     @property
     def filename(self):
         return f'{self.message_id}-{self.name}.{self.type}'
    
+    @property
+    def path(self) -> Path:
+        return (Path(self.base) / self.filename).resolve()
+
     @property
     def content(self):
         if self.data is None:    
-            with open((Path(self.base) / self.filename).resolve(), 'rb') as f:
+            with open(self.path, 'rb') as f:
                 self.data = f.read()
         return self.data
     
@@ -104,8 +161,9 @@ class Asset:
         return hash(self.filename)
     
     def save(self):
-        with open((Path(self.base) / self.filename).resolve(), 'wb') as f:
+        with open(self.path, 'wb') as f:
             f.write(self.data)
+        self.version = time.time_ns()
 
     @property
     def as_dict(self):
@@ -114,6 +172,7 @@ class Asset:
             'name': self.name,
             'type': self.type,
             'base': self.base,
+            'version': self.version,
         }
     
 class Assets(Storage):
@@ -121,10 +180,19 @@ class Assets(Storage):
     def __init__(self, base_dir: str) -> None:
         super().__init__()
         self.base_dir = base_dir
-        
+        # Assets by message id and name, so a message's assets are a single lookup.
+        self.by_message: dict[str, dict[str, Asset]] = {}
+
+    def __delitem__(self, key):
+        asset = self.records.pop(key)
+        self.by_message.get(asset.message_id, {}).pop(asset.name, None)
 
     def add(self, asset: Asset):
         self.records[asset.filename] = asset
+        self.by_message.setdefault(asset.message_id, {})[asset.name] = asset
+
+    def for_message(self, message_id: str) -> dict[str, Asset]:
+        return self.by_message.get(message_id, {})
 
     def load(self, *assets_dict: dict):
         self.__init__(self.base_dir)
@@ -174,11 +242,13 @@ class Messages(Storage):
             self.add(message)
 
 class Session:
-    def __init__(self, id: str, name: str = None, theme: str = None, guidelines: str = None, assets_dir: str = 'assets') -> None:
+    def __init__(self, id: str, name: str = None, theme: str = None, guidelines: str = None, assets_dir: str = 'assets', tier: str = None, user: str = None) -> None:
         self.id = id
         self.name = name
         self.theme = theme
         self.guidelines = guidelines
+        self.tier = tier
+        self.user = user
         self.messages = Messages()
         self.entities = Entities()
         self.assets = Assets(base_dir=assets_dir) 
@@ -207,6 +277,8 @@ class Session:
             'name': self.name,
             'theme': self.theme,
             'guidelines': self.guidelines,
+            'tier': self.tier,
+            'user': self.user,
             'entities': self.entities.as_list,
             'assets': self.assets.as_list,
         }       
@@ -243,8 +315,11 @@ class StoryState:
     
 class Functions:
 
-    def __init__(self, *functions: callable) -> None:
+    def __init__(self, *functions: callable, log: Callable[[str], None] = print) -> None:
         self.__functions: dict[str, callable] = {}
+        self.__validators: dict[str, callable] = {}
+        # Failed calls are reported here, such as to the app's action log.
+        self.log = log
         self.add_many(*functions)
 
     def __setitem__(self, key, value):
@@ -270,6 +345,53 @@ class Functions:
         for function in functions:
             self[function.__name__] = function
 
+    def compile(self, tools: list[dict]):
+        ''' Compiles the tool parameter schemas used to validate arguments before dispatch. '''
+        self.__validators = compile_tools(tools)
+
+    def dispatch(self, func_name: str, arguments: str, **bound: Any) -> str:
+        ''' Validates the raw JSON arguments and calls the function.
+
+        Bound keyword arguments, such as the session the run belongs to, are
+        passed to the function as is. They aren't part of its schema and can't
+        be set by the assistant.
+
+        Errors are returned as a JSON tool output rather than raised, so the
+        assistant can correct the call within the same run.
+        '''
+        if func_name not in self.__functions:
+            return self.__failure('unknown_function', func_name, f'Unknown function: {func_name}. Available: {", ".join(self.__functions)}')
+
+        try:
+            kwds = json.loads(arguments or '{}')
+        except ValueError as e:
+            return self.__failure('invalid_arguments', func_name, f'Arguments are not valid JSON: {e}')
+
+        try:
+            if func_name in self.__validators:
+                kwds = self.__validators[func_name](kwds, 'arguments')
+            elif not isinstance(kwds, dict):
+                raise ValidationError(['arguments: expected an object'])
+        except ValidationError as e:
+            return self.__failure('invalid_arguments', func_name, 'Arguments do not match the function schema.', e.errors)
+
+        try:
+            return str(self(func_name, **{**kwds, **bound}))
+        except Exception as e:
+            return self.__failure('function_error', func_name, f'{type(e).__name__}: {e}')
+
+    def __failure(self, type: str, func_name: str, message: str, details: list[str] = None) -> str:
+        output = self.error(type, func_name, message, details)
+        self.log(f'Function call failed: {output}')
+        return output
+
+    @staticmethod
+    def error(type: str, func_name: str, message: str, details: list[str] = None) -> str:
+        error = {'type': type, 'function': func_name, 'message': message}
+        if details:
+            error['details'] = details
+        return json.dumps({'error': error})
+
 @dataclass
 class ImageGenArgs:
     model: str      = 'dall-e-3'
@@ -280,30 +402,82 @@ class ImageGenArgs:
     def as_dict(self):
         return asdict(self)
 
+    @property
+    def price_key(self) -> str:
+        # Images are priced by quality and size as well as model.
+        return f'{self.model}/{self.quality}/{self.size}'
+
 class InteractiveStories:
 
-    def __init__(self, client: OpenAI = None, conf_file: str = 'config/bots.toml', save_file: str = 'save.json', asset_dir: str = 'assets'):
-        self.client = client or OpenAI()
+    def __init__(self, client: OpenAI = None, conf_file: str = 'config/bots.toml', save_file: str = 'save.json', asset_dir: str = 'assets', cassette: Cassette = None, persist: bool = True):
         self.conf_file = conf_file
         self.save_file = save_file
+        # Worker processes don't write the save file; their results are saved by the submitting process.
+        self.persist = persist
         self.asset_dir = asset_dir
+        self.action_log = []
         # Create the asset directory if it doesn't exist.
         Path(self.asset_dir).mkdir(parents=True, exist_ok=True)
         
+        if client is None and cassette is not None and not cassette.recording:
+            client = cassette.offline_client()
+
+        if client is None:
+            transport = Transport.shared(**self.load_config('transport'))
+            self.client = transport.client('api')
+            self.poll_client = transport.client('polling')
+            self.media_client = transport.client('generation')
+            self.upload_client = transport.client('uploads')
+            if transport.http2_requested and not transport.http2:
+                self.log_action('HTTP/2 requested but the h2 package is not installed. Falling back to HTTP/1.1.')
+        else:
+            self.client = self.poll_client = self.media_client = self.upload_client = client
+
         self.image_args = ImageGenArgs()
         self.storystate = StoryState()
-        self.assistants = AssistantsAPI(self.client)
+        self.assistants = AssistantsAPI(self.client, self.upload_client, self.poll_client)
+        self.image_generator = generate_image
+        self.audio_generator = generate_audio
         self.storyfuncs = Functions(
             self.set_story_config,
             self.get_story_config,
             self.get_entity_names,
             self.set_entity_bio,
             self.get_entity_bio,
+            self.get_entity_bios,
+            self.set_entity_bios,
+            self.get_story_state,
             self.get_generated_image,
+            log=self.log_action,
         )
+        self.storyfuncs.compile(self.load_tools())
+        self.router = Router.from_config(self.load_config())
+        worker = self.load_config('worker')
+        # Each process has its own buckets, so with workers enabled the limits
+        # are split between them and the UI process.
+        governor.configure(**self.load_config('governor'), processes=worker.get('processes', 1) + 1 if worker.get('enabled') else 1)
         self.storybotid = None
         self.activesess = None
-        self.action_log = []
+        # Sessions are changed by the UI, prompt drains and narration threads.
+        # Changes to entities, messages and assets, and the snapshot taken by
+        # save(), hold the state lock. API calls are made outside of it.
+        self.state_lock = threading.RLock()
+        self.save_lock = threading.Lock()
+        self.queues: dict[str, PromptQueue] = {}
+        self.queues_lock = threading.Lock()
+        usage = self.load_config('usage')
+        self.usage = UsageLedger(usage.get('database', 'usage.db'), usage.get('prices'), usage.get('budgets'))
+        self.jobs = None
+        if persist and worker.get('enabled'):
+            self.jobs = JobQueue.from_config(worker)
+
+        if cassette is not None:
+            cassette.install(self)
+
+        # Created after the cassette is installed, so pool threads are recorded too.
+        # The pool is started by the UI; command line tools never fill it.
+        self.warm_threads = WarmThreads(self.assistants, log=self.log_action, **self.load_config('warm_pool'))
+        atexit.register(self.warm_threads.close)
 
 
     def log_action(self, action: str):
@@ -358,77 +532,197 @@ class InteractiveStories:
         self.activate_session(self.activesess)
     
     def save(self):
+        if not self.persist:
+            return
         self.log_action(f'Saving session to: {self.save_file}')
 
-        with open(self.save_file, 'w') as f:
-            json.dump({
-                'storystate': self.storystate.as_dict,
-                'storybotid': self.storybotid,
-                'activesess': self.activesess,
-            }, f)
+        with self.save_lock:
+            with self.state_lock:
+                save = {
+                    'storystate': self.storystate.as_dict,
+                    'storybotid': self.storybotid,
+                    'activesess': self.activesess,
+                }
+            # Write a temporary file and swap it in, so a crash mid-write never leaves a truncated save.
+            directory = os.path.dirname(os.path.abspath(self.save_file))
+            with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.save-', suffix='.tmp', delete=False) as f:
+                json.dump(save, f)
+            try:
+                os.replace(f.name, self.save_file)
+            except Exception:
+                os.unlink(f.name)
+                raise
+
+    def load_config(self, section: str = 'storybot') -> dict:
+        with open(resolve_file(self.conf_file), 'r') as f:
+            return toml.load(f).get(section, {})
+
+    def load_tools(self) -> list[dict]:
+        with open(resolve_file(self.load_config()['tools']), 'r') as f:
+            return json.load(f)
 
     def create_assistant(self) -> str:
         self.log_action(f'Creating assistant from: {self.conf_file}')
 
-        with open(resolve_file(self.conf_file), 'r') as f:
-            storybot = toml.load(f)['storybot']
+        storybot = self.load_config()
+        tools = self.load_tools()
+        self.storyfuncs.compile(tools)
 
         return self.assistants.add_assistant(
             name=storybot['name'],
             description=storybot['desc'],
             instructions=render_template(storybot['instruction_template']),
             model=storybot['model'],
-            tools=json.load(open(resolve_file(storybot['tools']))),
+            tools=tools,
         ).id
 
     def update_assistant(self):
         self.log_action(f'Updating assistant from: {self.conf_file}')
-        with open(resolve_file(self.conf_file), 'r') as f:
-            storybot = toml.load(f)['storybot']
+        storybot = self.load_config()
+        tools = self.load_tools()
+        self.storyfuncs.compile(tools)
+        self.router = Router.from_config(storybot)
 
         self.assistants.update_assistant(
             self.storybotid,
             name=storybot['name'],
             description=storybot['desc'],
             instructions=render_template(storybot['instruction_template']),
-            tools=json.load(open(resolve_file(storybot['tools']))),
+            tools=tools,
             model=storybot['model'],
         )
 
-    def activate_session(self, session_id: str = None):
-        if session_id is None:
+    def activate_session(self, session_id: str = None, save: bool = True, user: str = None):
+        created = session_id is None
+        if created:
             self.log_action(f'Creating a session.')
-            self.activesess = self.assistants.add_thread().id
+            self.activesess = self.warm_threads.take() or self.assistants.add_thread().id
         else:
             self.log_action(f'Activating session: {session_id}')
             self.activesess = session_id
 
-        if self.activesess not in self.storystate.sessions:
-            self.storystate.sessions.add(Session(self.activesess))
+        with self.state_lock:
+            if self.activesess not in self.storystate.sessions:
+                self.storystate.sessions.add(Session(self.activesess, user=user))
 
-        self.save()
+        if save:
+            self.save()
+        # New threads are empty, so there are no messages to load.
+        if created:
+            return
         # Load the messages from the session
-        self.storystate.sessions[self.activesess].messages.load_messages(
-            *[
-                Message.from_api(message)
-                for message in self.assistants.messages(thread_id=self.activesess)
-            ]
-        )
+        messages = [Message.from_api(message) for message in self.assistants.messages(thread_id=self.activesess)]
+        with self.state_lock:
+            self.storystate.sessions[self.activesess].messages.load_messages(*messages)
         
     def add_message(self, session_id: str, content: str, role: str = 'user', metadata: dict = None) -> Message:
-        return self.messages.add(
-            Message.from_api(
-                self.assistants.add_message(session_id, role, content, metadata=metadata or {})
-            )
-        )
+        message = Message.from_api(self.assistants.add_message(session_id, role, content, metadata=metadata or {}))
+        with self.state_lock:
+            return self.sessions[session_id].messages.add(message)
     
-    def prompt_and_wait(self, content: str, role: str = 'user'):
-        self.add_message(self.activesess, content, role, metadata={'type': 'prompt'})
-        self.wait_for_run(
-            self.activesess,
-            self.assistants.add_run(self.activesess, self.storybotid).id,
-            post_run_metadata={'type': 'narrative'}
-        )
+    def prompt_and_wait(self, content: str, role: str = 'user', session_id: str = None, progress: dict = None, checkpoint: Callable[[dict], None] = None):
+        ''' Adds the prompt to the session's thread, runs the assistant, and waits for the run to finish.
+
+        `progress` holds the ids of the message and run already created for
+        this prompt, for example by a worker that stopped mid-run, so the prompt
+        isn't posted twice and an active run isn't started over. `checkpoint` is
+        called with the progress as each is created.
+        '''
+        session_id = session_id or self.activesess
+        session = self.sessions[session_id]
+        progress = dict(progress or {})
+        checkpoint = checkpoint or (lambda progress: None)
+
+        if 'message_id' in progress:
+            # The prompt is already in the thread; only the local copy is missing.
+            with self.state_lock:
+                session.messages.add(Message(progress['message_id'], role, content, {'type': 'prompt'}))
+            # The run may have been started before its id was recorded.
+            if 'run_id' not in progress and (runs := self.assistants.runs(session_id, order='desc', limit=1)):
+                if runs[0].status in ('queued', 'in_progress', 'requires_action'):
+                    progress['run_id'] = runs[0].id
+
+        if 'run_id' in progress:
+            self.log_action(f'Resuming run: {progress["run_id"]} in session: {session_id}')
+            return self.wait_for_run(session_id, progress['run_id'], post_run_metadata={'type': 'narrative'})
+
+        # Raises BudgetExceeded before anything is added to the thread.
+        budget = self.usage.check_budget(session_id, session.user)
+        if 'message_id' not in progress:
+            progress['message_id'] = self.add_message(session_id, content, role, metadata={'type': 'prompt'}).id
+            checkpoint(progress)
+
+        tier = self.router.route(session, content)
+        if budget == 'downgrade' and (downgrade := self.usage.budgets.get('downgrade_tier')) in self.router.tiers:
+            self.log_action(f'Session: {session_id} is over its soft budget.')
+            tier = self.router.tiers[downgrade]
+
+        run_args = {}
+        if tier is not None:
+            self.log_action(f'Routing run to tier: {tier.name} with model: {tier.model}')
+            run_args = tier.run_args()
+
+        progress['run_id'] = self.assistants.add_run(session_id, self.storybotid, **run_args).id
+        checkpoint(progress)
+        self.wait_for_run(session_id, progress['run_id'], post_run_metadata={'type': 'narrative'})
+
+    def prompt_queue(self, session_id: str = None) -> PromptQueue:
+        session_id = session_id or self.activesess
+        with self.queues_lock:
+            if session_id not in self.queues:
+                self.queues[session_id] = PromptQueue(**self.load_config('queue'))
+            return self.queues[session_id]
+
+    def submit_prompt(self, content: str, session_id: str = None) -> bool:
+        ''' Queues a prompt for the session. Returns True if a run was started, or False if it's waiting on an active run. '''
+        session_id = session_id or self.activesess
+        queue = self.prompt_queue(session_id)
+
+        if not queue.put(content):
+            self.log_action(f'Queued prompt for session: {session_id}. Queue depth: {len(queue)}')
+            return False
+
+        threading.Thread(target=self.drain_prompts, args=(session_id, queue), daemon=True).start()
+        return True
+
+    def drain_prompts(self, session_id: str, queue: PromptQueue):
+        # Runs until the queue is empty, so prompts sent during a run start as soon as it finishes.
+        try:
+            while (prompt := queue.take()) is not None:
+                if self.jobs is not None:
+                    self.run_job('prompt', session_id, content=prompt)
+                else:
+                    self.prompt_and_wait(prompt, session_id=session_id)
+        except Exception as e:
+            self.log_action(f'Prompt failed for session: {session_id}. Error: {e}')
+            if dropped := queue.fail(e):
+                self.log_action(f'Dropped {len(dropped)} queued prompt(s) for session: {session_id}')
+
+    def session_busy(self, session_id: str = None) -> bool:
+        session_id = session_id or self.activesess
+        return session_id in self.queues and self.queues[session_id].busy
+
+    def pop_prompt_error(self, session_id: str = None) -> tuple[Exception, list[str]] | None:
+        ''' Returns and clears the last error raised while draining the session's prompts, with the queued prompts it dropped. '''
+        session_id = session_id or self.activesess
+        if session_id not in self.queues:
+            return None
+        queue = self.queues[session_id]
+        if queue.error is None:
+            return None
+        failed = queue.error, queue.dropped
+        queue.error, queue.dropped = None, []
+        return failed
+
+    def queue_depth(self, session_id: str = None) -> int:
+        session_id = session_id or self.activesess
+        return len(self.queues[session_id]) if session_id in self.queues else 0
+
+    def set_session_tier(self, tier: str = None, session_id: str = None):
+        session_id = session_id or self.activesess
+        self.log_action(f'Setting tier for session: {session_id} to: {tier}')
+        self.sessions[session_id].tier = tier
+        self.save()
 
     def wait_for_run(self, session_id: str, run_id: str, post_run_metadata: dict = None):
         self.log_action(f'Waiting for run: {run_id} in session: {session_id} with post_run_metadata: {post_run_metadata}')
@@ -436,7 +730,12 @@ class InteractiveStories:
         try:
             run = self.assistants.wait_for_run(session_id, run_id)
         except RunError as e:
-            self.log_action(f'Run failed: {e.run.status}. Error: {e.run.last_error.code} - {e.run.last_error.message}')
+            self.record_run_usage(session_id, e.run)
+            # Expired, cancelled and incomplete runs have no last error.
+            if (error := e.run.last_error) is not None:
+                self.log_action(f'Run failed: {e.run.status}. Error: {error.code} - {error.message}')
+            else:
+                self.log_action(f'Run failed: {e.run.status}.')
             raise e
 
         if run.status == 'requires_action':
@@ -448,7 +747,7 @@ class InteractiveStories:
                 # Call the functions.
                 try:
                     called = run.required_action.submit_tool_outputs.tool_calls
-                    called = list(self.call_functions(called))
+                    called = list(self.call_functions(called, session_id))
                 except Exception as e:
                     self.log_action(f'Error calling functions: {e}')
                     # Before we raise the exception, we need to cancel the run.
@@ -465,8 +764,10 @@ class InteractiveStories:
                 raise Exception(f'Unknown action required: {run.required_action}')
         else:
             self.log_action(f'Run completed with status: {run.status}')
+            self.record_run_usage(session_id, run)
             # Update the local messages with the latest messages from the API.
-            for message in self.assistants.messages(thread_id=session_id, after=self.messages.last.id):
+            messages = self.sessions[session_id].messages
+            for message in self.assistants.messages(thread_id=session_id, after=messages.last.id):
                 message = Message.from_api(message)
 
                 # If the post run metadata contains key/value pairs not in the message metadata, add them.
@@ -481,45 +782,203 @@ class InteractiveStories:
                         self.assistants.update_message(message.id, session_id, message.metadata)
                         
                 # Add the message to the local session.
-                self.messages.add(message)
+                with self.state_lock:
+                    messages.add(message)
         
-    def call_functions(self, tool_calls, auto_save: bool = True):
+    def call_functions(self, tool_calls, session_id: str, auto_save: bool = True):
+        # The functions act on the run's session, which may not be the active one.
         for call in tool_calls:
-            self.log_action(f'Calling function: {call.function.name} with arguments: {call.function.arguments}')
+            self.log_action(f'Calling function: {call.function.name} with arguments: {call.function.arguments} for session: {session_id}')
             yield {
                 'tool_call_id': call.id,
-                'output': self.storyfuncs(call.function.name, **json.loads(call.function.arguments)),
+                'output': self.storyfuncs.dispatch(call.function.name, call.function.arguments, session_id=session_id),
             }
         if auto_save:
             self.save()
     
     def delete_session(self, session_id: str):
-        self.log_action(f'Deleting session: {session_id}')
-        # 1. attempt to delete the thread.
-        if self.assistants.delete_thread(session_id):
-            # 2. remove the session from the local storystate
-            if session_id in self.storystate.sessions:
-                del self.storystate.sessions[session_id]
-            # 3. if the deleted thread was the active session, activate the last session, or create a new one.
-            if session_id == self.activesess:
-                self.activesess = None    
-                try:
-                    self.activesess = self.storystate.sessions.last.id
-                except:
-                    pass
-                finally:
-                    self.activate_session(self.activesess)
-            
-            self.save()
-        else:
+        if self.session_busy(session_id):
+            raise Exception(f'Session: {session_id} is busy. Try again once its prompts finish.')
+        if session_id not in self.delete_sessions(session_id):
             raise Exception(f'Failed to delete thread: {session_id}')
 
-    def get_narration(self, message_id: str, text: str, voice: str = 'alloy', format='opus', model='tts-1'):
+    def delete_sessions(self, *session_ids: str, workers: int = 8) -> list[str]:
+        ''' Deletes the threads concurrently and saves once. Returns the ids of the deleted sessions. '''
+        self.log_action(f'Deleting sessions: {", ".join(session_ids)}')
+
+        def delete(session_id: str) -> bool:
+            if self.session_busy(session_id):
+                self.log_action(f'Skipping busy session: {session_id}')
+                return False
+            try:
+                return self.assistants.delete_thread(session_id)
+            except openai.NotFoundError:
+                # The thread is already gone, so only the local session remains.
+                return True
+            except Exception as e:
+                self.log_action(f'Failed to delete thread: {session_id}. Error: {e}')
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            deleted = [
+                session_id
+                for session_id, ok in zip(session_ids, pool.map(delete, session_ids))
+                if ok
+            ]
+
+        # Remove the sessions from the local storystate.
+        with self.state_lock:
+            for session_id in deleted:
+                if session_id in self.storystate.sessions:
+                    del self.storystate.sessions[session_id]
+
+        # If the active session was deleted, activate the last session, or create a new one.
+        if self.activesess in deleted:
+            self.activesess = None
+            try:
+                self.activesess = self.storystate.sessions.last.id
+            except:
+                pass
+            finally:
+                self.activate_session(self.activesess, save=False)
+
+        self.save()
+        return deleted
+
+    def busy(self) -> bool:
+        ''' True while any session has prompts draining or jobs are queued or running in workers. '''
+        with self.queues_lock:
+            queues = list(self.queues.values())
+        if any(queue.busy for queue in queues):
+            return True
+        if self.jobs is not None:
+            depth = self.jobs.depth()
+            return depth.get('queued', 0) + depth.get('running', 0) > 0
+        return False
+
+    def collect_assets(self, batch_size: int = 100, dry_run: bool = False, min_age: float = 300.0) -> dict[str, int]:
+        ''' Deletes files in the asset directory that no live session references. Returns the files and bytes reclaimed.
+
+        Runs and narrations write their files before the session references
+        them, so collection is refused while anything is in flight, and files
+        modified within the last `min_age` seconds are never deleted.
+        '''
+        if self.busy():
+            raise RuntimeError('Assets can\'t be collected while prompts or jobs are running. Try again once they finish.')
+
+        self.log_action(f'Collecting orphaned assets in: {self.asset_dir}')
+        cutoff = time.time() - min_age
+        # Runs, narrations and job merges add assets from other threads.
+        with self.state_lock:
+            live = {
+                (Path(asset.base) / asset.filename).resolve()
+                for session in self.sessions
+                for asset in session.assets
+            }
+
+        report = {'files': 0, 'bytes': 0}
+
+        def remove(batch: list[tuple[Path, int]]):
+            for path, size in batch:
+                if not dry_run:
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        continue
+                report['files'] += 1
+                report['bytes'] += size
+
+        batch = []
+        with os.scandir(self.asset_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or (path := Path(entry.path).resolve()) in live:
+                    continue
+                if (stat := entry.stat()).st_mtime > cutoff:
+                    continue
+                batch.append((path, stat.st_size))
+                if len(batch) >= batch_size:
+                    remove(batch)
+                    batch = []
+        remove(batch)
+
+        self.log_action(f'Collected {report["files"]} orphaned assets, reclaiming {report["bytes"]} bytes.')
+        return report
+
+    def record_run_usage(self, session_id: str, run):
+        # Usage is only reported once a run reaches a terminal status, and covers all of its steps.
+        if (usage := getattr(run, 'usage', None)) is None:
+            return
+        cost = self.usage.record(
+            session_id,
+            self.sessions[session_id].user,
+            'run',
+            run.model,
+            ref=run.id,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+        )
+        self.log_action(f'Run: {run.id} used {usage.prompt_tokens} prompt and {usage.completion_tokens} completion tokens costing: ${cost:.4f}')
+
+    def usage_summary(self, session_id: str = None) -> dict:
+        session_id = session_id or self.activesess
+        session = self.sessions[session_id]
+        today = datetime.now(timezone.utc).date().isoformat()
+        return {
+            'session': self.usage.totals(session_id=session_id),
+            'user_today': self.usage.totals(user_id=session.user or 'anonymous', day=today),
+            'all_today': self.usage.totals(day=today),
+        }
+
+    def run_job(self, kind: str, session_id: str, **payload):
+        ''' Runs a job in a worker process, waits for it, and merges its changes into the session. '''
+        session = self.sessions[session_id]
+        with self.state_lock:
+            snapshot = session.as_dict
+        job_id = self.jobs.submit(kind, session_id, {
+            'session': snapshot,
+            'storybotid': self.storybotid,
+            **payload,
+        })
+        self.log_action(f'Submitted job: {job_id} ({kind}) for session: {session_id}')
+
+        result = self.jobs.wait(job_id)
+        # Merge rather than replace, so changes made here while the job ran, such
+        # as a rename or another job's narration, aren't lost.
+        with self.state_lock:
+            for key, value in result['config'].items():
+                setattr(session, key, value)
+            session.entities.add_many(*[Entity(**entity) for entity in result['entities']])
+            for asset in result['assets']:
+                session.assets.add(Asset(**asset))
+            session.messages.load_messages(*[Message(**message) for message in result['messages']])
+        self.log_action(f'Job: {job_id} finished.')
+        self.save()
+
+    def request_narration(self, message_id: str, text: str, **options):
+        ''' Generates the narration in a worker when one is configured, without blocking the caller. '''
+        # Resolved here, since the narration may finish after another session is activated.
+        session_id = self.activesess
+        if self.jobs is None:
+            return self.get_narration(message_id, text, session_id=session_id, **options)
+
+        def narrate(session_id: str):
+            try:
+                self.run_job('narration', session_id, message_id=message_id, text=text, options=options)
+            except Exception as e:
+                self.log_action(f'Narration failed for message: {message_id}. Error: {e}')
+
+        threading.Thread(target=narrate, args=(session_id,), daemon=True).start()
+
+    def get_narration(self, message_id: str, text: str, voice: str = 'alloy', format='opus', model='tts-1', session_id: str = None):
+        session_id = session_id or self.activesess
+        session = self.sessions[session_id]
         self.log_action(f'Generating narration for message: {message_id} with text: {text} and voice: {voice} in format: {format}')
-        audio = generate_audio(self.client, text, voice=voice, format=format, model=model)
+        audio = self.audio_generator(self.media_client, text, voice=voice, format=format, model=model)
+        self.usage.record(session_id, session.user, 'tts', model, ref=message_id, units=len(text))
         asset = Asset(message_id, 'narration', format, data=audio.content, base=self.asset_dir)
         asset.save()
-        self.active_session.assets.add(asset)
+        with self.state_lock:
+            session.assets.add(asset)
         self.save()
     
     def asset(self, message_id, name: str, format='opus'):
@@ -530,6 +989,12 @@ class InteractiveStories:
         except KeyError:
             return None
     
+    def message_assets(self, message_id: str) -> dict[str, Asset]:
+        try:
+            return self.active_session.assets.for_message(message_id)
+        except AttributeError:
+            return {}
+
     def get_last_run(self, session_id: str):
         self.log_action(f'Getting last run for session: {session_id}')
         return self.assistants.runs(session_id, order='desc', limit=1)[0]
@@ -537,50 +1002,108 @@ class InteractiveStories:
     # Assistant Functions 
     # 
     # These functions are called by AI assistants as "function calls."
+    # Each call is bound to the session of the run that made it, which is
+    # passed as the `session_id` keyword argument rather than read from the
+    # active session, since runs finish on background threads.
     # The caller is responsible for calling the save method from this class 
     # to persist any changes to the local session.
     ###########################################################################
-    def set_story_config(self, theme: str = None, guidelines: str = None):
-        self.active_session.theme = theme
-        self.active_session.guidelines = guidelines
+    def set_story_config(self, theme: str = None, guidelines: str = None, *, session_id: str):
+        session = self.sessions[session_id]
+        with self.state_lock:
+            session.theme = theme
+            session.guidelines = guidelines
         return f'Configured theme to {theme} and guidelines to {guidelines}'
     
-    def get_story_config(self):
-        return f'Theme: {self.active_session.theme} | Guidelines: {self.active_session.guidelines}'
-
-    def get_entity_names(self):
-        return ','.join([entity.name for entity in self.active_session.entities])
-
-    def set_entity_bio(self, type: str = None,  name: str = None,  desc: str = None):
-        if name not in self.active_session.entities:
-            self.active_session.entities.add(Entity(type, name, desc))
-        else:
-            self.active_session.entities[name].type = type
-            self.active_session.entities[name].desc = desc
+    def get_story_config(self, *, session_id: str):
+        session = self.sessions[session_id]
+        return f'Theme: {session.theme} | Guidelines: {session.guidelines}'
+
+    def get_entity_names(self, *, session_id: str):
+        with self.state_lock:
+            return ','.join([entity.name for entity in self.sessions[session_id].entities])
+
+    def set_entity_bio(self, type: str = None,  name: str = None,  desc: str = None, aliases: list[str] = None, *, session_id: str):
+        entities = self.sessions[session_id].entities
+        with self.state_lock:
+            # Match existing entities loosely, so 'alice liddell' updates 'Alice Liddell' rather than duplicating it.
+            if (key := entities.resolve(name)) is None:
+                entities.add(Entity(type, name, desc, aliases))
+            else:
+                entity = entities[key]
+                name = entity.name
+                entity.type = type
+                entity.desc = desc
+                if aliases is not None:
+                    entity.aliases = aliases
+                    # Re-add the entity so the name index picks up the new aliases.
+                    entities.add(entity)
         return f'Entity: {name} of type: {type} set to: {desc}'
     
-    def get_entity_bio(self, name: str):
-        return str(self.active_session.entities[name])
-
-    def get_generated_image(self, desc: str, entities: list[str]):
-        for name in entities:
-            try:
-                entity = self.entities[name]
-                desc += f'Entity: {name} of type: {entity.type} is described as: {entity.desc}'
-            except KeyError:
-                print(f'Could not find entity: {name}')
-                
-        image = generate_image(self.client, desc, **self.image_args.as_dict()).data[0]
+    def get_entity_bio(self, name: str, *, session_id: str):
+        entities = self.sessions[session_id].entities
+        with self.state_lock:
+            if (entity := entities.find(name)) is not None:
+                return str(entity)
+            candidates = entities.candidates(name)
+        # Unknown names are reported rather than raised so a small slip by the
+        # model doesn't cancel the run.
+        if candidates:
+            return f'{name} | Not found. Did you mean: {",".join(entity.name for entity in candidates)}?'
+        return f'{name} | Not found.'
+
+    def get_entity_bios(self, names: list[str], *, session_id: str):
+        # One line per entity.
+        return '\n'.join(self.get_entity_bio(name, session_id=session_id) for name in names)
+
+    def set_entity_bios(self, entities: list[dict], *, session_id: str):
+        with self.state_lock:
+            for entity in entities:
+                self.set_entity_bio(entity.get('type'), entity.get('name'), entity.get('desc'), entity.get('aliases'), session_id=session_id)
+        return f'Set {len(entities)} entities: {",".join(entity.get("name") for entity in entities)}'
+
+    def get_story_state(self, *, session_id: str):
+        session = self.sessions[session_id]
+        with self.state_lock:
+            state = {
+                'theme': session.theme,
+                'guidelines': session.guidelines,
+                'entities': session.entities.as_list,
+            }
+        # Compact JSON so the full state fits in a single tool output.
+        return json.dumps(state, separators=(',', ':'))
+
+    def get_generated_image(self, desc: str, entities: list[str] = None, *, session_id: str):
+        session = self.sessions[session_id]
+        missing = []
+        with self.state_lock:
+            for name in entities or []:
+                if (entity := session.entities.find(name)) is not None:
+                    desc += f'Entity: {entity.name} of type: {entity.type} is described as: {entity.desc}'
+                else:
+                    self.log_action(f'Could not find entity: {name}')
+                    candidates = session.entities.candidates(name)
+                    missing.append(f'{name} (did you mean: {",".join(entity.name for entity in candidates)}?)' if candidates else name)
+            message_id = session.messages.last.id
+
+        image = self.image_generator(self.media_client, desc, **self.image_args.as_dict()).data[0]
+        self.usage.record(session_id, session.user, 'image', self.image_args.price_key, units=1)
         # Log with the revised prompt.
         self.log_action(f'Generated image for prompt: {desc} with revised prompt: {image.revised_prompt}')
         # 
-        asset = Asset(self.messages.last.id, 'visualization', 'png', data=b64decode(image.model_dump()["b64_json"]), base=self.asset_dir)
+        asset = Asset(message_id, 'visualization', 'png', data=b64decode(image.model_dump()["b64_json"]), base=self.asset_dir)
         asset.save()
-        self.active_session.assets.add(asset)
+        with self.state_lock:
+            session.assets.add(asset)
+        if missing:
+            return f'Success! Image presented to the user. These entities were not found and were left out: {"; ".join(missing)}'
         return f'Success! Image presented to the user.'
     ###########################################################################
     # UI Assistance Functions
     ###########################################################################
+    def request_metrics(self):
+        return governor.metrics()
+
     def welcome(self):
         return render_template('welcome.md')
     
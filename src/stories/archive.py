@@ -0,0 +1,355 @@
+''' Streaming export and import of story sessions.
+
+An archive is an uncompressed tar stream. Each session is written as a
+gzipped JSONL member holding its session, entity, message and asset records,
+followed by one gzipped member per asset file:
+
+    sessions/<session id>/records.jsonl.gz
+    sessions/<session id>/assets/<asset filename>.gz
+
+Members are compressed in a thread pool and written in order, with a bounded
+number in flight, so memory use doesn't grow with the size of the archive.
+Imports read the tar stream member by member and record each imported session
+in a progress file next to the archive, so an interrupted import can resume.
+Threads are recorded as soon as they're created, so threads left behind by an
+interrupted import are deleted when it resumes, unless their session was saved.
+'''
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import argparse
+import gzip
+import io
+import json
+from pathlib import Path
+import tarfile
+import time
+from typing import Iterable, Iterator
+
+import openai
+
+from stories.app import Asset, Entity, InteractiveStories, Session
+
+ARCHIVE_VERSION = 1
+
+
+###############################################################################
+# Export
+###############################################################################
+def session_records(stories: InteractiveStories, session: Session) -> Iterator[dict]:
+    yield {
+        'kind': 'session',
+        'version': ARCHIVE_VERSION,
+        'id': session.id,
+        'name': session.name,
+        'theme': session.theme,
+        'guidelines': session.guidelines,
+        'tier': session.tier,
+        'user': session.user,
+    }
+    for entity in session.entities:
+        yield {'kind': 'entity', **entity.as_dict}
+    # Messages aren't stored locally, so they're read from the thread.
+    for message in stories.assistants.messages(thread_id=session.id):
+        yield {
+            'kind': 'message',
+            'id': message.id,
+            'role': message.role,
+            'text': message.content[0].text.value if message.content[0].type == 'text' else str(message),
+            'metadata': message.metadata,
+        }
+    for asset in session.assets:
+        yield {'kind': 'asset', **asset.as_dict}
+
+
+def compress_records(records: Iterable[dict], level: int) -> bytes:
+    return gzip.compress(
+        b''.join(json.dumps(record, separators=(',', ':')).encode() + b'\n' for record in records),
+        compresslevel=level,
+    )
+
+
+def compress_file(path: Path, level: int) -> bytes:
+    with open(path, 'rb') as f:
+        return gzip.compress(f.read(), compresslevel=level)
+
+
+def export_members(stories: InteractiveStories, sessions: Iterable[Session], pool: Executor, level: int) -> Iterator[tuple[str, Future]]:
+    for session in sessions:
+        # The records are gathered here, since the API client shouldn't be shared
+        # across the pool, and compressed in the pool.
+        records = list(session_records(stories, session))
+        yield f'sessions/{session.id}/records.jsonl.gz', pool.submit(compress_records, records, level)
+
+        for asset in session.assets:
+            path = Path(asset.base) / asset.filename
+            if path.exists():
+                yield f'sessions/{session.id}/assets/{asset.filename}.gz', pool.submit(compress_file, path, level)
+            else:
+                stories.log_action(f'Skipping missing asset: {path}')
+
+
+def add_member(archive: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    archive.addfile(info, io.BytesIO(data))
+
+
+def export_sessions(stories: InteractiveStories, path: str, session_ids: list[str] = None, workers: int = 4, level: int = 6) -> int:
+    ''' Writes the selected sessions (all sessions by default) to an archive. Returns the number of sessions exported. '''
+    sessions = [stories.sessions[id] for id in session_ids] if session_ids else list(stories.sessions)
+    stories.log_action(f'Exporting {len(sessions)} sessions to: {path}')
+
+    pending: deque[tuple[str, Future]] = deque()
+
+    def write_next():
+        name, future = pending.popleft()
+        add_member(archive, name, future.result())
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, tarfile.open(path, 'w|') as archive:
+        for member in export_members(stories, sessions, pool, level):
+            pending.append(member)
+            # Bound the compressed data held in memory.
+            while len(pending) > workers * 2:
+                write_next()
+        while pending:
+            write_next()
+
+    return len(sessions)
+
+
+###############################################################################
+# Import
+###############################################################################
+class ImportProgress:
+    ''' Tracks which archived sessions have been imported, keyed by their original id. '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.done: dict[str, str] = {}
+        self.threads: dict[str, str] = {}
+        self.pending: list[dict] = []
+
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if 'thread' in entry:
+                        self.threads[entry['thread']] = entry['source']
+                    else:
+                        self.done[entry['source']] = entry['session']
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, source_id: str):
+        return source_id in self.done
+
+    @property
+    def orphans(self) -> list[str]:
+        ''' Threads created by an earlier run for sessions that were never saved. '''
+        saved = set(self.done.values())
+        return [thread_id for thread_id in self.threads if thread_id not in saved]
+
+    def add_thread(self, source_id: str, thread_id: str):
+        ''' Persists a created thread right away, ahead of the session that uses it. '''
+        self.threads[thread_id] = source_id
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'source': source_id, 'thread': thread_id}) + '\n')
+
+    def add(self, source_id: str, session_id: str):
+        self.done[source_id] = session_id
+        self.pending.append({'source': source_id, 'session': session_id})
+
+    def commit(self):
+        ''' Persists the pending entries. Called only after the story state is saved. '''
+        with open(self.path, 'a') as f:
+            for entry in self.pending:
+                f.write(json.dumps(entry) + '\n')
+        self.pending = []
+
+
+class SessionImport:
+    ''' Rebuilds one archived session, remapping thread and message ids when threads are recreated. '''
+
+    def __init__(self, stories: InteractiveStories, records: Iterable[dict], recreate_threads: bool, progress: ImportProgress) -> None:
+        self.stories = stories
+        self.recreate_threads = recreate_threads
+        self.progress = progress
+        self.message_ids: dict[str, str] = {}
+        self.assets: dict[str, Asset] = {}
+        self.session = None
+        self.source_id = None
+
+        for record in records:
+            match record.pop('kind'):
+                case 'session':
+                    self.begin(record)
+                case 'entity':
+                    self.session.entities.add(Entity(**record))
+                case 'message':
+                    self.add_message(record)
+                case 'asset':
+                    self.add_asset(record)
+
+    def begin(self, record: dict):
+        if record.pop('version') > ARCHIVE_VERSION:
+            raise ValueError(f'Unsupported archive version for session: {record["id"]}')
+        self.source_id = record.pop('id')
+        if self.recreate_threads:
+            session_id = self.stories.assistants.add_thread().id
+            self.progress.add_thread(self.source_id, session_id)
+        else:
+            session_id = self.source_id
+        self.session = Session(session_id, assets_dir=self.stories.asset_dir)
+        for key, value in record.items():
+            setattr(self.session, key, value)
+
+    def add_message(self, record: dict):
+        if not self.recreate_threads:
+            return
+        message = self.stories.assistants.add_message(
+            self.session.id, record['role'], record['text'], metadata=record['metadata'] or {}
+        )
+        self.message_ids[record['id']] = message.id
+
+    def add_asset(self, record: dict):
+        source = Asset(**record)
+        if not safe_asset(source, self.stories.asset_dir):
+            self.stories.log_action(f'Skipping asset with an unsafe filename: {source.filename!r}')
+            return
+        asset = Asset(
+            self.message_ids.get(source.message_id, source.message_id),
+            source.name,
+            source.type,
+            base=self.stories.asset_dir,
+        )
+        self.assets[source.filename] = asset
+        self.session.assets.add(asset)
+
+    def asset_path(self, filename: str) -> Path | None:
+        if (asset := self.assets.get(filename)) is None:
+            return None
+        return Path(asset.base) / asset.filename
+
+
+def safe_asset(asset: Asset, asset_dir: str) -> bool:
+    ''' True if the asset's file stays inside the asset directory. '''
+    for part in (asset.message_id, asset.name, asset.type):
+        if not isinstance(part, str) or not part or '/' in part or '\\' in part or '..' in part:
+            return False
+    base = Path(asset_dir).resolve()
+    return (base / asset.filename).resolve().parent == base
+
+
+def delete_orphans(stories: InteractiveStories, progress: ImportProgress):
+    for thread_id in progress.orphans:
+        if thread_id in stories.sessions:
+            # Saved, but the import stopped before its progress was committed.
+            progress.add(progress.threads[thread_id], thread_id)
+            continue
+        try:
+            stories.assistants.delete_thread(thread_id)
+        except openai.NotFoundError:
+            # Already deleted when an earlier run resumed.
+            continue
+        stories.log_action(f'Deleted thread left by an interrupted import: {thread_id}')
+
+
+def write_asset(path: Path, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(gzip.decompress(data))
+
+
+def import_sessions(stories: InteractiveStories, path: str, recreate_threads: bool = True, workers: int = 4, save_every: int = 50) -> int:
+    ''' Imports the sessions from an archive, skipping any already imported. Returns the number of sessions imported. '''
+    stories.log_action(f'Importing sessions from: {path}')
+    progress = ImportProgress(f'{path}.progress')
+    delete_orphans(stories, progress)
+    pending: deque[Future] = deque()
+    imported = 0
+    current: SessionImport = None
+    skipping = None
+
+    def finish():
+        nonlocal imported, current
+        if current is not None:
+            # Wait on this session's assets before it's recorded as imported.
+            while pending:
+                pending.popleft().result()
+            stories.sessions.add(current.session)
+            progress.add(current.source_id, current.session.id)
+            imported += 1
+            if imported % save_every == 0:
+                stories.save()
+                progress.commit()
+        current = None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, tarfile.open(path, 'r|') as archive:
+        for member in archive:
+            parts = member.name.split('/')
+            if not member.isfile() or len(parts) < 3 or parts[0] != 'sessions':
+                continue
+            source_id = parts[1]
+
+            if parts[2] == 'records.jsonl.gz':
+                finish()
+                if source_id in progress:
+                    skipping = source_id
+                    continue
+                skipping = None
+                data = gzip.decompress(archive.extractfile(member).read())
+                current = SessionImport(
+                    stories,
+                    (json.loads(line) for line in data.splitlines() if line),
+                    recreate_threads,
+                    progress,
+                )
+            elif parts[2] == 'assets' and len(parts) == 4 and source_id != skipping and current is not None:
+                filename = parts[3].removesuffix('.gz')
+                if (target := current.asset_path(filename)) is None:
+                    stories.log_action(f'Skipping unreferenced asset: {member.name}')
+                    continue
+                pending.append(pool.submit(write_asset, target, archive.extractfile(member).read()))
+                while len(pending) > workers * 2:
+                    pending.popleft().result()
+        finish()
+
+    stories.save()
+    progress.commit()
+    return imported
+
+
+###############################################################################
+# Command line
+###############################################################################
+def main(args: list[str] = None):
+    parser = argparse.ArgumentParser(description='Export or import story sessions.')
+    parser.add_argument('--save-file', default='save.json')
+    parser.add_argument('--asset-dir', default='assets')
+    parser.add_argument('--workers', type=int, default=4)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help='Export sessions to an archive.')
+    export.add_argument('archive')
+    export.add_argument('sessions', nargs='*', help='Session ids. Defaults to all sessions.')
+    export.add_argument('--level', type=int, default=6, help='Compression level.')
+
+    load = commands.add_parser('import', help='Import sessions from an archive.')
+    load.add_argument('archive')
+    load.add_argument('--keep-threads', action='store_true', help='Reuse the archived thread ids instead of creating new threads.')
+    load.add_argument('--save-every', type=int, default=50)
+
+    args = parser.parse_args(args)
+    stories = InteractiveStories(save_file=args.save_file, asset_dir=args.asset_dir)
+    stories.load()
+
+    if args.command == 'export':
+        count = export_sessions(stories, args.archive, args.sessions, workers=args.workers, level=args.level)
+        print(f'Exported {count} sessions to: {args.archive}')
+    else:
+        count = import_sessions(stories, args.archive, recreate_threads=not args.keep_threads, workers=args.workers, save_every=args.save_every)
+        print(f'Imported {count} sessions from: {args.archive}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@ import openai
 from openai import OpenAI
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_not_exception_type, retry_if_exception_type
 
+from stories.governor import CircuitOpenError, governed, governor
+
 
 class RunError(Exception):
     ''' Raised when a run has an unsuccessful status. '''
@@ -13,23 +15,31 @@ class RunError(Exception):
 class AssistantsAPI:
     ''' A wrapper around the OpenAI Assistant API. '''
     
-    def __init__(self, client: OpenAI):
+    def __init__(self, client: OpenAI, upload_client: OpenAI = None, poll_client: OpenAI = None):
         self.client = client
+        # Used for calls with large request bodies, such as assistant instructions and tools.
+        self.upload_client = upload_client or client
+        # Used for run and step status polls, which should fail fast.
+        self.poll_client = poll_client or client
 
      
     def assistant(self, id: str):
         try:
-            return self.client.beta.assistants.retrieve(id)
-        except:
+            return governor.call('assistants', self.client.beta.assistants.retrieve, id)
+        except openai.NotFoundError:
+            # Only a missing assistant returns None. Outages, throttling and
+            # exhausted retries are raised, so callers don't replace it.
             return None
     
     
+    @governed('assistants')
     def assistants(self, order: str = 'desc', limit: str = '20', **kwargs):
         return list(self.client.beta.assistants.list(order=order, limit=limit, **kwargs))
     
     
+    @governed('assistants', idempotent=False)
     def add_assistant(self, name: str, **kwargs):
-        return self.client.beta.assistants.create(name=name, **kwargs)
+        return self.upload_client.beta.assistants.create(name=name, **kwargs)
     
     
     def update_assistant(self, assistant_id: str, **kwargs):
@@ -39,7 +49,9 @@ class AssistantsAPI:
         for key, value in kwargs.items():
             setattr(assistant, key, value)
         # Save the changes.
-        return self.client.beta.assistants.update(
+        return governor.call(
+            'assistants',
+            self.upload_client.beta.assistants.update,
             assistant.id, 
             **assistant.model_dump(
                 exclude_unset=True,
@@ -51,26 +63,32 @@ class AssistantsAPI:
         )
 
     
+    @governed('assistants')
     def delete_assistant(self, assistant_id: str):
         return self.client.beta.assistants.delete(assistant_id)
 
     
+    @governed('threads')
     def thread(self, id: str):
         return self.client.beta.threads.retrieve(id)
     
     
+    @governed('threads', idempotent=False)
     def add_thread(self, **kwargs):
         return self.client.beta.threads.create(**kwargs)
 
     
+    @governed('threads')
     def delete_thread(self, thread_id: str):
         return self.client.beta.threads.delete(thread_id).deleted
 
     
+    @governed('messages')
     def messages(self, thread_id: str, order: str = 'asc', **kwargs):
         return list(self.client.beta.threads.messages.list(thread_id=thread_id, order=order, **kwargs))
     
     
+    @governed('messages', idempotent=False)
     def add_message(self, thread_id: str, role: str, content: str, **kwargs):
         return self.client.beta.threads.messages.create(
             thread_id=thread_id,
@@ -80,6 +98,7 @@ class AssistantsAPI:
         )
 
     
+    @governed('messages')
     def update_message(self, message_id: str, thread_id: str, metadata: dict):
         return self.client.beta.threads.messages.update(
             message_id=message_id,
@@ -88,14 +107,17 @@ class AssistantsAPI:
         )
 
     
+    @governed('polls')
     def run(self, thread_id: str, run_id: str):
-        return self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+        return self.poll_client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
     
     
+    @governed('runs')
     def runs(self, thread_id: str, order: str = 'asc', **kwargs):
         return list(self.client.beta.threads.runs.list(thread_id=thread_id, order=order, **kwargs))
     
     
+    @governed('runs', idempotent=False)
     def add_run(self, thread_id: str, assistant_id: str, **kwargs):
         return self.client.beta.threads.runs.create(
             thread_id=thread_id,
@@ -104,6 +126,7 @@ class AssistantsAPI:
         )
     
     
+    @governed('runs')
     def update_run(self, run_id: str, thread_id: str, metadata: dict):
         return self.client.beta.threads.runs.update(
             run_id=run_id,
@@ -112,14 +135,17 @@ class AssistantsAPI:
         )
 
     
+    @governed('polls')
     def step(self, thread_id: str, run_id: str, step_id: str):
-        return self.client.beta.threads.runs.steps.retrieve(thread_id=thread_id, run_id=run_id, step_id=step_id)
+        return self.poll_client.beta.threads.runs.steps.retrieve(thread_id=thread_id, run_id=run_id, step_id=step_id)
     
     
+    @governed('polls')
     def steps(self, thread_id: str, run_id: str, order: str = 'asc', **kwargs):
-        return list(self.client.beta.threads.runs.steps.list(thread_id=thread_id, run_id=run_id, order=order, **kwargs))
+        return list(self.poll_client.beta.threads.runs.steps.list(thread_id=thread_id, run_id=run_id, order=order, **kwargs))
 
     
+    @governed('runs', idempotent=False)
     def submit_tool_outputs(self, thread_id: str, run_id: str, tool_outputs: list[dict[str, str]]):
         return self.client.beta.threads.runs.submit_tool_outputs(
             thread_id=thread_id,
@@ -128,10 +154,11 @@ class AssistantsAPI:
         )
     
     
+    @governed('runs')
     def cancel_run(self, thread_id: str, run_id: str):
         return self.client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
     
-    @retry(stop=stop_after_attempt(10), wait=wait_fixed(1.5), retry=retry_if_not_exception_type(RunError))
+    @retry(stop=stop_after_attempt(10), wait=wait_fixed(1.5), retry=retry_if_not_exception_type((RunError, CircuitOpenError)))
     def wait_for_run(self, thread_id: str, run_id: str) -> openai.types.beta.threads.Run:
         match (run := self.run(thread_id, run_id)).status:
             case 'queued' | 'in_progress' | 'cancelling':
@@ -146,6 +173,7 @@ class AssistantsAPI:
 # Non-assistant API calls.
 ###############################################################################
 
+@governed('images', idempotent=False)
 def generate_image(client, prompt, style='natural', number=1, size='1024x1024', model='dall-e-3', format='b64_json', quality='standard', **kwargs):
     return client.images.generate(
         prompt=prompt, 
@@ -159,6 +187,7 @@ def generate_image(client, prompt, style='natural', number=1, size='1024x1024',
     )
 
 
+@governed('audio', idempotent=False)
 def generate_audio(client, prompt, model='tts-1', voice='nova', format='opus', **kwargs):
     return client.audio.speech.create(
         model=model,
@@ -0,0 +1,284 @@
+from base64 import b64decode, b64encode
+from collections import defaultdict, deque
+from functools import wraps
+import atexit
+import gzip
+import importlib
+import json
+import threading
+import time
+from typing import Any, Callable
+
+import httpx
+import openai
+from openai import OpenAI
+from pydantic import BaseModel
+
+from stories.assistant import RunError
+
+
+class CassetteError(Exception):
+    ''' Raised when a replayed call has no matching recording. '''
+
+
+class RecordedError(Exception):
+    ''' Replays an exception whose class can't be rebuilt, such as one recorded by an older cassette. '''
+    def __init__(self, type: str, message: str, *args):
+        super().__init__(f'{type}: {message}', *args)
+        self.type = type
+
+
+class BinaryContent:
+    ''' Stands in for binary API responses, such as generated audio. '''
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def read(self) -> bytes:
+        return self.content
+
+
+###############################################################################
+# Encoding
+###############################################################################
+# Stands in for the request of a replayed API error.
+REPLAY_REQUEST = httpx.Request('POST', 'http://replay.invalid')
+
+
+def import_object(path: str) -> Any:
+    ''' Imports an object from a 'module:qualified.name' path. '''
+    module, name = path.split(':')
+    obj = importlib.import_module(module)
+    for part in name.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+
+def encode(value: Any) -> Any:
+    match value:
+        case None | bool() | int() | float() | str():
+            return value
+        case list() | tuple():
+            return [encode(item) for item in value]
+        case dict():
+            return {key: encode(item) for key, item in value.items()}
+        case BaseModel():
+            return {'__model__': f'{type(value).__module__}:{type(value).__qualname__}', 'data': value.model_dump(mode='json')}
+        case bytes():
+            return {'__bytes__': b64encode(value).decode()}
+        case _ if isinstance(getattr(value, 'content', None), bytes):
+            return {'__binary__': b64encode(value.content).decode()}
+    return repr(value)
+
+
+def decode(value: Any) -> Any:
+    match value:
+        case list():
+            return [decode(item) for item in value]
+        case {'__model__': path, 'data': data}:
+            return import_object(path).model_validate(data)
+        case {'__bytes__': data}:
+            return b64decode(data)
+        case {'__binary__': data}:
+            return BinaryContent(b64decode(data))
+        case dict():
+            return {key: decode(item) for key, item in value.items()}
+    return value
+
+
+def encode_error(error: Exception) -> dict:
+    encoded = {
+        'type': type(error).__name__,
+        'class': f'{type(error).__module__}:{type(error).__qualname__}',
+        'message': str(error),
+    }
+    match error:
+        case RunError():
+            encoded['run'] = encode(error.run)
+        case openai.APIStatusError():
+            encoded['status'] = error.status_code
+            encoded['headers'] = dict(error.response.headers)
+            encoded['body'] = encode(error.body)
+        case openai.APIError():
+            # Connection errors only hold the request, which is rebuilt on replay.
+            pass
+        case _:
+            encoded['attrs'] = encode(vars(error))
+    return encoded
+
+
+def decode_error(error: dict) -> Exception:
+    ''' Rebuilds a recorded exception as its original class, so callers that check the type behave as they did live. '''
+    if 'run' in error:
+        return RunError(decode(error['run']))
+    try:
+        cls = import_object(error['class'])
+        if issubclass(cls, openai.APIStatusError):
+            response = httpx.Response(error['status'], headers=error['headers'], request=REPLAY_REQUEST)
+            return cls(error['message'], response=response, body=decode(error['body']))
+        if issubclass(cls, openai.APITimeoutError):
+            return cls(request=REPLAY_REQUEST)
+        if issubclass(cls, openai.APIConnectionError):
+            return cls(message=error['message'], request=REPLAY_REQUEST)
+        # Other exceptions take arguments that aren't recorded, so they're
+        # rebuilt from their message and attributes without calling __init__.
+        rebuilt = cls.__new__(cls)
+        rebuilt.args = (error['message'],)
+        vars(rebuilt).update(decode(error.get('attrs', {})))
+        return rebuilt
+    except Exception:
+        return RecordedError(error['type'], error['message'])
+
+
+def request_key(name: str, args: tuple, kwargs: dict) -> str:
+    # Clients and other non-serializable arguments are reduced to their type name.
+    return json.dumps([name, args, kwargs], sort_keys=True, separators=(',', ':'), default=lambda o: type(o).__name__)
+
+
+###############################################################################
+# Cassettes
+###############################################################################
+class Cassette:
+    ''' Records API calls to a gzipped JSONL file and replays them offline.
+
+    Each line holds the operation name, a key built from its arguments, the
+    encoded response or error, and how long the call took. On replay, calls are
+    matched by key in recorded order, so repeated polls of the same run return
+    each recorded status in turn. With `realtime` enabled the recorded latency
+    is reproduced; otherwise responses are returned immediately.
+    '''
+
+    def __init__(self, path: str, mode: str = 'replay', realtime: bool = False, strict: bool = True) -> None:
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cassette mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.realtime = realtime
+        self.strict = strict
+        self.lock = threading.Lock()
+        self.file = None
+        # Set when a recording that wasn't closed cleanly is replayed. Reported to the action log on install.
+        self.truncated: str = None
+        self.by_key: dict[str, deque] = defaultdict(deque)
+        self.by_name: dict[str, deque] = defaultdict(deque)
+
+        if mode == 'replay':
+            self.load()
+        else:
+            # Flush the gzip trailer even if close is never called.
+            atexit.register(self.close)
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == 'record'
+
+    def load(self):
+        count = 0
+        try:
+            with gzip.open(self.path, 'rt') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.by_key[entry['key']].append(entry)
+                    self.by_name[entry['name']].append(entry)
+                    count += 1
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+            # A recording that wasn't closed cleanly ends in a truncated stream or line.
+            self.truncated = f'Cassette {self.path} is truncated after {count} calls: {e}'
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, entry: dict):
+        with self.lock:
+            if self.file is None:
+                self.file = gzip.open(self.path, 'wt')
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.file.flush()
+
+    def take(self, name: str, key: str) -> dict:
+        with self.lock:
+            if self.by_key[key]:
+                entry = self.by_key[key].popleft()
+                self.by_name[name].remove(entry)
+                return entry
+            if not self.strict and self.by_name[name]:
+                # Fall back to the next recorded call of the same operation.
+                entry = self.by_name[name].popleft()
+                self.by_key[entry['key']].remove(entry)
+                return entry
+        raise CassetteError(f'No recorded response for: {key}')
+
+    def record_call(self, name: str, func: Callable, args: tuple, kwargs: dict):
+        key = request_key(name, args, kwargs)
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.append({'name': name, 'key': key, 'error': encode_error(e), 'elapsed': time.monotonic() - started})
+            raise e
+        self.append({'name': name, 'key': key, 'response': encode(result), 'elapsed': time.monotonic() - started})
+        return result
+
+    def replay_call(self, name: str, args: tuple, kwargs: dict):
+        entry = self.take(name, request_key(name, args, kwargs))
+        if self.realtime:
+            time.sleep(entry['elapsed'])
+        if (error := entry.get('error')) is not None:
+            raise decode_error(error)
+        return decode(entry['response'])
+
+    def wrap(self, name: str, func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.recording:
+                return self.record_call(name, func, args, kwargs)
+            return self.replay_call(name, args, kwargs)
+        return wrapper
+
+    def install(self, stories):
+        ''' Routes the API calls made by an InteractiveStories instance through the cassette. '''
+        if self.truncated is not None:
+            stories.log_action(self.truncated)
+        stories.assistants = CassetteProxy(stories.assistants, self)
+        stories.image_generator = self.wrap('generate_image', stories.image_generator)
+        stories.audio_generator = self.wrap('generate_audio', stories.audio_generator)
+        return stories
+
+    @staticmethod
+    def offline_client() -> OpenAI:
+        ''' A client that fails fast if a call slips past the cassette during replay. '''
+        return OpenAI(api_key='replay', base_url='http://replay.invalid', max_retries=0)
+
+
+class CassetteProxy:
+    ''' Wraps each public method of an API object with a cassette.
+
+    Composite methods, which are built from other API calls, aren't recorded
+    themselves. They run against the proxy so each underlying call, such as
+    every poll in `wait_for_run`, is recorded and replayed in turn.
+    '''
+    composite = ('wait_for_run',)
+
+    def __init__(self, target: Any, cassette: Cassette) -> None:
+        self.target = target
+        self.cassette = cassette
+        self.methods: dict[str, Callable] = {}
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if name not in self.methods:
+            if name in self.composite:
+                self.methods[name] = self.unwrap(name)
+            else:
+                self.methods[name] = self.cassette.wrap(name, attr)
+        return self.methods[name]
+
+    def unwrap(self, name: str) -> Callable:
+        func = getattr(type(self.target), name)
+        if not self.cassette.recording and not self.cassette.realtime and hasattr(func, 'retry_with'):
+            # Replayed polls return immediately, so don't wait between them either.
+            func = func.retry_with(sleep=lambda seconds: None)
+        return func.__get__(self)
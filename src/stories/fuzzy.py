@@ -0,0 +1,91 @@
+from collections import defaultdict
+import re
+import unicodedata
+
+
+def normalize(text: str) -> str:
+    ''' Lowercases, strips accents and collapses punctuation and whitespace into single spaces. '''
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r'[\W_]+', ' ', text.casefold()).strip()
+
+
+def trigrams(text: str) -> set[str]:
+    ''' Returns the trigrams of a normalized string, padded so short names still produce grams. '''
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    ''' A trigram index mapping names and aliases to record keys.
+
+    Exact (normalized) matches are a dictionary lookup. Everything else is scored
+    using the Dice coefficient over trigrams, and only keys sharing at least one
+    trigram with the query are considered, so lookups stay fast as the index grows.
+    '''
+
+    def __init__(self, threshold: float = 0.5) -> None:
+        self.threshold = threshold
+        self.exact_terms: dict[str, set[str]] = defaultdict(set)
+        self.grams: dict[str, set[str]] = defaultdict(set)
+        self.terms: dict[str, dict[str, set[str]]] = defaultdict(dict)
+
+    def __contains__(self, key):
+        return key in self.terms
+
+    def __len__(self):
+        return len(self.terms)
+
+    def add(self, key: str, *names: str):
+        self.remove(key)
+        for name in (key, *names):
+            if not (term := normalize(name)) or term in self.terms[key]:
+                continue
+            grams = trigrams(term)
+            self.terms[key][term] = grams
+            self.exact_terms[term].add(key)
+            for gram in grams:
+                self.grams[gram].add(key)
+
+    def remove(self, key: str):
+        for term, grams in self.terms.pop(key, {}).items():
+            self.exact_terms[term].discard(key)
+            if not self.exact_terms[term]:
+                del self.exact_terms[term]
+            for gram in grams:
+                self.grams[gram].discard(key)
+                if not self.grams[gram]:
+                    del self.grams[gram]
+
+    def exact(self, name: str) -> str | None:
+        ''' Returns the key whose name or alias normalizes to the same term, if exactly one does. '''
+        keys = self.exact_terms.get(normalize(name), ())
+        return next(iter(keys)) if len(keys) == 1 else None
+
+    def candidates(self, name: str, limit: int = 5, min_score: float = 0.0) -> list[tuple[str, float]]:
+        ''' Returns up to `limit` (key, score) pairs scoring at least `min_score`, ordered from best to worst match. '''
+        if not (term := normalize(name)):
+            return []
+
+        if keys := self.exact_terms.get(term):
+            return [(key, 1.0) for key in sorted(keys)][:limit]
+
+        query = trigrams(term)
+        shared = set().union(*(self.grams.get(gram, ()) for gram in query))
+
+        scores = {}
+        for key in shared:
+            # Score each key by its best matching term (the name or one of its aliases).
+            scores[key] = max(
+                2 * len(query & grams) / (len(query) + len(grams))
+                for grams in self.terms[key].values()
+            )
+        scores = {key: score for key, score in scores.items() if score >= min_score}
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def best(self, name: str) -> str | None:
+        ''' Returns the best matching key, or None if nothing scores above the threshold. '''
+        for key, score in self.candidates(name, limit=1):
+            if score >= self.threshold:
+                return key
+        return None
@@ -0,0 +1,291 @@
+from collections import defaultdict
+from functools import wraps
+import random
+import threading
+import time
+from typing import Any, Callable
+
+import httpx
+import openai
+
+
+class CircuitOpenError(Exception):
+    ''' Raised without calling the API while the circuit for an endpoint family is open. '''
+    def __init__(self, family: str, retry_in: float, *args):
+        super().__init__(f'Circuit open for: {family}. Retry in {retry_in:.1f}s.', *args)
+        self.family = family
+        self.retry_in = retry_in
+
+
+class ThrottledError(Exception):
+    ''' Raised when a rate limit token can't be acquired within the acquire timeout. '''
+    def __init__(self, family: str, wait: float, *args):
+        super().__init__(f'Rate limit for: {family} requires waiting {wait:.1f}s.', *args)
+        self.family = family
+        self.wait = wait
+
+
+class TokenBucket:
+    ''' A thread-safe token bucket refilled continuously at `rate` tokens per second. '''
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, timeout: float) -> float:
+        ''' Reserves a token and returns how long the caller must wait before using it. '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait > timeout:
+                return -wait
+            # Tokens may go negative; later callers queue behind this reservation.
+            self.tokens -= 1
+            return wait
+
+
+class CircuitBreaker:
+    ''' Opens after `threshold` consecutive failures and lets a single trial call through after `reset_timeout`.
+
+    A trial that never reports back (for example, one throttled before it was
+    sent) expires after another `reset_timeout`, so the circuit can't stick open.
+    '''
+
+    def __init__(self, threshold: int, reset_timeout: float) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> float:
+        ''' Returns 0 if a call may proceed, otherwise the seconds until the next trial call. '''
+        with self.lock:
+            now = time.monotonic()
+            match self.state:
+                case 'closed':
+                    return 0.0
+                case 'half_open':
+                    if self.trial_at is None or now - self.trial_at >= self.reset_timeout:
+                        self.trial_at = now
+                        return 0.0
+                    # Wait on the trial in flight.
+                    return self.reset_timeout - (now - self.trial_at)
+                case _:
+                    return self.reset_timeout - (now - self.opened_at)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_at = None
+
+
+class RequestGovernor:
+    ''' Shared rate limiting, retries and circuit breaking for OpenAI API calls.
+
+    Calls are grouped into endpoint families (for example: runs, messages, images),
+    each with its own token bucket and circuit breaker. A single instance is shared
+    by the whole process so concurrent sessions draw from the same limits. When
+    several processes call the API, such as the UI and its workers, each is
+    configured with its share of the limits.
+    '''
+
+    def __init__(self, **config) -> None:
+        self.lock = threading.Lock()
+        self.configure(**config)
+
+    def configure(self,
+        limits: dict[str, dict] = None,
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        acquire_timeout: float = 60.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        processes: int = 1,
+    ):
+        ''' Applies the settings. Every InteractiveStories instance configures the shared
+        governor, so the buckets, breakers and counters are only reset when the settings change.
+        '''
+        settings = dict(
+            limits=limits or {},
+            max_retries=max_retries,
+            backoff_base=backoff_base,
+            backoff_max=backoff_max,
+            acquire_timeout=acquire_timeout,
+            failure_threshold=failure_threshold,
+            reset_timeout=reset_timeout,
+            processes=processes,
+        )
+        with self.lock:
+            if settings == getattr(self, 'settings', None):
+                return
+            self.settings = settings
+            self.limits = limits or {}
+            self.processes = processes
+            self.max_retries = max_retries
+            self.backoff_base = backoff_base
+            self.backoff_max = backoff_max
+            self.acquire_timeout = acquire_timeout
+            self.failure_threshold = failure_threshold
+            self.reset_timeout = reset_timeout
+            self.buckets: dict[str, TokenBucket] = {}
+            self.breakers: dict[str, CircuitBreaker] = {}
+            self.counters: dict[str, dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def bucket(self, family: str) -> TokenBucket | None:
+        with self.lock:
+            if family not in self.buckets:
+                limit = self.limits.get(family, self.limits.get('default'))
+                # Limits are for all processes together.
+                self.buckets[family] = TokenBucket(limit['rate'] / self.processes, max(1, limit['burst'] / self.processes)) if limit else None
+            return self.buckets[family]
+
+    def breaker(self, family: str) -> CircuitBreaker:
+        with self.lock:
+            if family not in self.breakers:
+                self.breakers[family] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self.breakers[family]
+
+    def count(self, family: str, name: str, value: float = 1):
+        with self.lock:
+            self.counters[family][name] += value
+
+    def metrics(self) -> dict[str, dict[str, Any]]:
+        with self.lock:
+            families = set(self.counters) | set(self.breakers)
+            counters = {family: dict(self.counters[family]) for family in families}
+            breakers = dict(self.breakers)
+        for family, breaker in breakers.items():
+            counters[family]['circuit'] = breaker.state
+        return counters
+
+    @staticmethod
+    def unsent(error: Exception) -> bool:
+        ''' True if the request failed while connecting, so the server never saw it. '''
+        return isinstance(error, openai.APIConnectionError) and isinstance(
+            error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout)
+        )
+
+    @classmethod
+    def retryable(cls, error: Exception, idempotent: bool = True) -> bool:
+        # A 429 is rejected before any work is done, so it's always safe to retry.
+        if isinstance(error, openai.RateLimitError):
+            return True
+        if idempotent:
+            return isinstance(error, (openai.InternalServerError, openai.APIConnectionError))
+        # Retrying a request that may have been applied (a read timeout or a 5xx)
+        # can duplicate messages, runs or images.
+        return cls.unsent(error)
+
+    @staticmethod
+    def outage(error: Exception) -> bool:
+        ''' Rate limit errors are retried but don't count towards opening the circuit. '''
+        return isinstance(error, (openai.InternalServerError, openai.APIConnectionError))
+
+    @staticmethod
+    def retry_after(error: Exception) -> float | None:
+        try:
+            headers = error.response.headers
+        except AttributeError:
+            return None
+        try:
+            if (value := headers.get('retry-after-ms')) is not None:
+                return float(value) / 1000
+            if (value := headers.get('retry-after')) is not None:
+                return float(value)
+        except ValueError:
+            pass
+        return None
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        # Full jitter, but never sooner than the server asked for.
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if (retry_after := self.retry_after(error)) is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def call(self, family: str, func: Callable, *args, idempotent: bool = True, **kwargs):
+        ''' Calls func under the family's limits. Non-idempotent calls are only retried if they were never sent. '''
+        breaker = self.breaker(family)
+
+        for attempt in range(self.max_retries + 1):
+            if (retry_in := breaker.allow()) > 0:
+                self.count(family, 'rejected')
+                raise CircuitOpenError(family, retry_in)
+
+            if (bucket := self.bucket(family)) is not None:
+                if (wait := bucket.reserve(self.acquire_timeout)) < 0:
+                    self.count(family, 'throttled')
+                    raise ThrottledError(family, -wait)
+                if wait > 0:
+                    self.count(family, 'wait_seconds', wait)
+                    time.sleep(wait)
+
+            self.count(family, 'calls')
+            started = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self.count(family, 'latency_seconds', time.monotonic() - started)
+
+                if self.outage(e):
+                    breaker.record_failure()
+                else:
+                    # Client errors mean the API is up.
+                    breaker.record_success()
+
+                if not self.retryable(e, idempotent):
+                    self.count(family, 'errors')
+                    raise e
+
+                if attempt == self.max_retries:
+                    self.count(family, 'errors')
+                    raise e
+
+                delay = self.backoff(attempt, e)
+                self.count(family, 'retries')
+                self.count(family, 'backoff_seconds', delay)
+                time.sleep(delay)
+            else:
+                self.count(family, 'latency_seconds', time.monotonic() - started)
+                self.count(family, 'successes')
+                breaker.record_success()
+                return result
+
+
+# The process-wide governor. Configured from bots.toml by InteractiveStories.
+governor = RequestGovernor()
+
+
+def governed(family: str, idempotent: bool = True):
+    ''' Routes calls to the decorated function through the shared governor. '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return governor.call(family, func, *args, idempotent=idempotent, **kwargs)
+        return wrapper
+    return decorator
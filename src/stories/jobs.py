@@ -0,0 +1,355 @@
+''' Out-of-process run orchestration.
+
+The UI process submits jobs to a durable SQLite queue and reads back their
+results. Worker processes claim jobs, run them with their own InteractiveStories
+instance, and return what changed in the session: config changes, new or
+updated entities, new assets and new messages. Workers never write the save
+file; the submitting process merges results and saves, so there's a single
+writer.
+
+Jobs for the same session run one at a time, in the order they were submitted.
+Each worker records a heartbeat while it runs. Jobs held by a worker whose
+heartbeat is older than `heartbeat_timeout` are requeued, and submitters stop
+waiting on queued jobs when no worker has a recent heartbeat. Prompt jobs
+record the ids of the message and run they create, so a requeued prompt waits
+on the existing run rather than posting the prompt again.
+
+Start the workers from the directory holding save.json and assets/:
+
+    python -m stories.jobs
+
+The worker count is set by `processes` in the [worker] config, which is also
+used to split the API rate limits between the UI process and the workers.
+'''
+from datetime import datetime, timezone
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable
+import uuid
+
+import toml
+
+from stories import resolve_file
+
+
+class JobFailed(Exception):
+    ''' Raised in the submitting process when a job fails in a worker. '''
+    def __init__(self, job: dict, *args):
+        super().__init__(job['error'], *args)
+        self.job = job
+
+
+class JobQueue:
+    ''' A durable job queue shared by the UI process and the workers. '''
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            result TEXT,
+            progress TEXT,
+            error TEXT,
+            worker TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+        CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, status);
+        CREATE TABLE IF NOT EXISTS workers (
+            id TEXT PRIMARY KEY,
+            heartbeat REAL NOT NULL
+        );
+    '''
+
+    def __init__(self,
+        database: str = 'jobs.db',
+        poll_interval: float = 0.5,
+        heartbeat_interval: float = 5.0,
+        heartbeat_timeout: float = 30.0,
+        wait_timeout: float = 900.0,
+    ) -> None:
+        self.database = database
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(self.schema)
+
+    @classmethod
+    def from_config(cls, worker: dict) -> 'JobQueue':
+        ''' Builds the queue from the [worker] section of the config. '''
+        options = ('database', 'poll_interval', 'heartbeat_interval', 'heartbeat_timeout', 'wait_timeout')
+        return cls(**{key: worker[key] for key in options if key in worker})
+
+    @staticmethod
+    def as_dict(row: sqlite3.Row) -> dict | None:
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        job['progress'] = json.loads(job['progress']) if job['progress'] is not None else {}
+        return job
+
+    def submit(self, kind: str, session_id: str, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO jobs (id, kind, session_id, payload, created_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, kind, session_id, json.dumps(payload), time.time()),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> dict | None:
+        with self.lock:
+            return self.as_dict(self.connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def beat(self, worker: str):
+        ''' Records that the worker is alive. '''
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO workers (id, heartbeat) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET heartbeat = excluded.heartbeat',
+                (worker, time.time()),
+            )
+
+    def live_workers(self) -> int:
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM workers WHERE heartbeat >= ?',
+                (time.time() - self.heartbeat_timeout,),
+            ).fetchone()[0]
+
+    def claim(self, worker: str) -> dict | None:
+        ''' Marks the oldest runnable job as running and returns it. '''
+        now = time.time()
+        with self.lock:
+            # Take the write lock up front so two workers can't claim the same job.
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                # Only jobs held by workers that stopped beating are taken back;
+                # a slow job on a live worker keeps running.
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL, started_at = NULL "
+                    "WHERE status = 'running' AND worker NOT IN (SELECT id FROM workers WHERE heartbeat >= ?)",
+                    (now - self.heartbeat_timeout,),
+                )
+                row = self.connection.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, started_at = ? "
+                    "WHERE id = ("
+                    "  SELECT id FROM jobs WHERE status = 'queued' "
+                    "  AND session_id NOT IN (SELECT session_id FROM jobs WHERE status = 'running') "
+                    "  ORDER BY created_at LIMIT 1"
+                    ") RETURNING *",
+                    (worker, now),
+                ).fetchone()
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+        return self.as_dict(row)
+
+    def checkpoint(self, job_id: str, worker: str, progress: dict) -> bool:
+        ''' Records how far a running job got, so it resumes from there if it's requeued. '''
+        with self.lock:
+            return self.connection.execute(
+                "UPDATE jobs SET progress = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (json.dumps(progress), job_id, worker),
+            ).rowcount == 1
+
+    def finish(self, job_id: str, worker: str, result: dict = None, error: str = None) -> bool:
+        ''' Stores the job's outcome. Returns False if the job was requeued and is no longer held by this worker. '''
+        with self.lock:
+            return self.connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                ('failed' if error is not None else 'done', json.dumps(result), error, time.time(), job_id, worker),
+            ).rowcount == 1
+
+    def cancel(self, job_id: str) -> bool:
+        ''' Cancels a job that no worker has claimed yet. Returns False if it was already claimed. '''
+        with self.lock:
+            return self.connection.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id),
+            ).rowcount == 1
+
+    def wait(self, job_id: str, timeout: float = None) -> dict:
+        ''' Polls until the job finishes. Returns its result, or raises JobFailed.
+
+        Raises TimeoutError after `timeout` seconds (`wait_timeout` by default),
+        or once a queued job has waited `heartbeat_timeout` with no live workers.
+        Queued jobs are cancelled before raising, so they don't run later.
+        '''
+        deadline = time.monotonic() + (self.wait_timeout if timeout is None else timeout)
+        while (job := self.get(job_id))['status'] in ('queued', 'running'):
+            if job['status'] == 'queued':
+                unclaimed = time.time() - job['created_at'] > self.heartbeat_timeout and not self.live_workers()
+                if (unclaimed or time.monotonic() > deadline) and self.cancel(job_id):
+                    raise TimeoutError(
+                        f'No workers are running to pick up job: {job_id}' if unclaimed else f'Timed out waiting on job: {job_id}'
+                    )
+            elif time.monotonic() > deadline:
+                raise TimeoutError(f'Timed out waiting on job: {job_id}')
+            time.sleep(self.poll_interval)
+
+        if job['status'] == 'failed':
+            raise JobFailed(job)
+        return job['result']
+
+    def depth(self) -> dict[str, int]:
+        with self.lock:
+            rows = self.connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    def prune(self, older_than: float = 86400.0):
+        ''' Deletes finished jobs, and workers that stopped beating, older than the given number of seconds. '''
+        cutoff = time.time() - older_than
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+                (cutoff,),
+            )
+            self.connection.execute('DELETE FROM workers WHERE heartbeat < ?', (cutoff,))
+
+
+###############################################################################
+# Workers
+###############################################################################
+def session_delta(before: dict, session) -> dict:
+    ''' Returns what a job changed in the session, for the submitting process to merge. '''
+    entities = {entity['name']: entity for entity in before.get('entities', [])}
+    assets = {(asset['message_id'], asset['name'], asset['type']) for asset in before.get('assets', [])}
+    return {
+        'config': {
+            key: getattr(session, key)
+            for key in ('theme', 'guidelines')
+            if getattr(session, key) != before.get(key)
+        },
+        'entities': [entity for entity in session.entities.as_list if entities.get(entity['name']) != entity],
+        'assets': [
+            asset.as_dict for asset in session.assets
+            if (asset.message_id, asset.name, asset.type) not in assets
+        ],
+        # The session starts without messages, so these are all new.
+        'messages': session.messages.as_list,
+    }
+
+
+def run_job(stories, job: dict, checkpoint: Callable[[dict], None] = None) -> dict:
+    ''' Runs a job against a worker's InteractiveStories instance and returns the changes to the session.
+
+    Prompt jobs pass their progress to `checkpoint` as they go, and resume from
+    the job's recorded progress.
+    '''
+    from stories.app import Session
+
+    payload = job['payload']
+    session = Session(job['session_id']).load(payload['session'])
+    # Only the session being worked on is held.
+    stories.storystate.sessions.load()
+    stories.storystate.sessions.add(session)
+    stories.storybotid = payload['storybotid']
+
+    match job['kind']:
+        case 'prompt':
+            stories.prompt_and_wait(
+                payload['content'],
+                payload.get('role', 'user'),
+                session_id=session.id,
+                progress=job.get('progress'),
+                checkpoint=checkpoint,
+            )
+        case 'narration':
+            stories.get_narration(payload['message_id'], payload['text'], session_id=session.id, **payload.get('options', {}))
+        case _:
+            raise ValueError(f'Unknown job kind: {job["kind"]}')
+
+    return session_delta(payload['session'], session)
+
+
+def heartbeat(queue: JobQueue, worker: str):
+    # Runs on its own thread, so long API calls don't stop the worker from beating.
+    while True:
+        try:
+            queue.beat(worker)
+        except Exception as e:
+            print(f'{worker} failed to record a heartbeat: {e}')
+        time.sleep(queue.heartbeat_interval)
+
+
+def work(conf_file: str, save_file: str, asset_dir: str, worker: str):
+    from stories.app import InteractiveStories
+
+    stories = InteractiveStories(conf_file=conf_file, save_file=save_file, asset_dir=asset_dir, persist=False)
+    queue = JobQueue.from_config(stories.load_config('worker'))
+    queue.beat(worker)
+    threading.Thread(target=heartbeat, args=(queue, worker), daemon=True).start()
+
+    while True:
+        if (job := queue.claim(worker)) is None:
+            time.sleep(queue.poll_interval)
+            continue
+
+        stories.log_action(f'{worker} running job: {job["id"]} ({job["kind"]}) for session: {job["session_id"]}')
+        try:
+            result = run_job(stories, job, lambda progress: queue.checkpoint(job['id'], worker, progress))
+        except Exception as e:
+            finished = queue.finish(job['id'], worker, error=f'{type(e).__name__}: {e}')
+        else:
+            finished = queue.finish(job['id'], worker, result=result)
+        if not finished:
+            stories.log_action(f'{worker} lost job: {job["id"]} after its heartbeat lapsed.')
+        # The action log is only useful per job in a worker.
+        stories.action_log.clear()
+
+
+def main(args: list[str] = None):
+    parser = argparse.ArgumentParser(description='Run story orchestration workers.')
+    parser.add_argument('--conf-file', default='config/bots.toml')
+    parser.add_argument('--save-file', default='save.json')
+    parser.add_argument('--asset-dir', default='assets')
+    parser.add_argument('--processes', type=int, help='Defaults to processes in the [worker] config.')
+    args = parser.parse_args(args)
+
+    # The rate limits are split by the configured count, so the UI and the workers agree on each process's share.
+    with open(resolve_file(args.conf_file), 'r') as f:
+        configured = toml.load(f).get('worker', {}).get('processes', 1)
+    if args.processes is None:
+        args.processes = configured
+    elif args.processes != configured:
+        print(f'Starting {args.processes} workers, but the rate limits are split for {configured}. Set processes in the [worker] config instead.')
+
+    processes = [
+        multiprocessing.Process(
+            target=work,
+            args=(args.conf_file, args.save_file, args.asset_dir, f'worker-{os.getpid()}-{i}'),
+            daemon=True,
+        )
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    print(f'{datetime.now(timezone.utc).isoformat()} Started {len(processes)} workers.')
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+from collections import deque
+import threading
+
+
+class PromptQueue:
+    ''' Prompts waiting for a session's active run to finish.
+
+    Only one caller drains the queue at a time: `put` returns True to the caller
+    that should start draining, and `take` returns None once the queue is empty,
+    at which point the queue is released for the next caller. With `coalesce`
+    enabled, consecutive queued prompts are merged into one message.
+    '''
+
+    def __init__(self, coalesce: bool = True, max_batch: int = 5, separator: str = '\n\n') -> None:
+        self.coalesce = coalesce
+        self.max_batch = max_batch
+        self.separator = separator
+        self.prompts: deque[str] = deque()
+        self.draining = False
+        self.error: Exception = None
+        # Prompts dropped by the last error.
+        self.dropped: list[str] = []
+        self.lock = threading.Lock()
+        self.idle = threading.Event()
+        self.idle.set()
+
+    def __len__(self):
+        return len(self.prompts)
+
+    @property
+    def busy(self) -> bool:
+        return not self.idle.is_set()
+
+    def put(self, content: str) -> bool:
+        with self.lock:
+            self.prompts.append(content)
+            if self.draining:
+                return False
+            self.draining = True
+            self.idle.clear()
+            return True
+
+    def take(self) -> str | None:
+        with self.lock:
+            if not self.prompts:
+                self.draining = False
+                self.idle.set()
+                return None
+            count = min(len(self.prompts), self.max_batch) if self.coalesce else 1
+            return self.separator.join(self.prompts.popleft() for _ in range(count))
+
+    def fail(self, error: Exception) -> list[str]:
+        ''' Stops draining after an error. Returns the queued prompts, which are dropped
+        rather than merged into the next, unrelated prompt. '''
+        with self.lock:
+            dropped, self.prompts = list(self.prompts), deque()
+            self.error, self.dropped = error, dropped
+            self.draining = False
+            self.idle.set()
+            return dropped
+
+    def wait(self, timeout: float = None) -> bool:
+        return self.idle.wait(timeout)
@@ -0,0 +1,79 @@
+from dataclasses import dataclass, field
+import re
+
+
+@dataclass
+class Tier:
+    ''' A model profile applied to a run as overrides of the assistant's settings. '''
+    name: str
+    model: str
+    additional_instructions: str = None
+
+    def run_args(self) -> dict:
+        args = {'model': self.model}
+        if self.additional_instructions:
+            args['additional_instructions'] = self.additional_instructions
+        return args
+
+
+@dataclass
+class Rule:
+    ''' Routes a prompt to a tier when every condition that's set matches. '''
+    tier: str
+    setup: bool = None
+    max_words: int = None
+    pattern: str = None
+    compiled: re.Pattern = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.pattern is not None:
+            self.compiled = re.compile(self.pattern, re.IGNORECASE)
+
+    def matches(self, session, prompt: str) -> bool:
+        if self.setup is not None:
+            # A session is in setup until the theme and guidelines are configured.
+            if self.setup != (session.theme is None or session.guidelines is None):
+                return False
+        if self.max_words is not None and len(prompt.split()) > self.max_words:
+            return False
+        if self.compiled is not None and not self.compiled.search(prompt):
+            return False
+        return True
+
+
+class Router:
+    ''' Picks the tier for each run.
+
+    A session's own tier takes precedence. Otherwise the first matching rule
+    wins, falling back to the default tier.
+    '''
+
+    def __init__(self, tiers: dict[str, Tier], rules: list[Rule], default: str = None) -> None:
+        self.tiers = tiers
+        self.rules = rules
+        self.default = default
+
+    @classmethod
+    def from_config(cls, storybot: dict) -> 'Router':
+        tiers = {
+            name: Tier(name, **tier)
+            for name, tier in storybot.get('tiers', {}).items()
+        }
+        rules = [Rule(**rule) for rule in storybot.get('routing', [])]
+        for rule in rules:
+            if rule.tier not in tiers:
+                raise ValueError(f'Routing rule references unknown tier: {rule.tier}')
+
+        default = storybot.get('default_tier')
+        if default is not None and default not in tiers:
+            raise ValueError(f'Unknown default tier: {default}')
+        return cls(tiers, rules, default)
+
+    def route(self, session, prompt: str) -> Tier | None:
+        ''' Returns the tier for the prompt, or None to use the assistant's own model. '''
+        if session.tier in self.tiers:
+            return self.tiers[session.tier]
+        for rule in self.rules:
+            if rule.matches(session, prompt):
+                return self.tiers[rule.tier]
+        return self.tiers.get(self.default)
@@ -0,0 +1,183 @@
+import json
+from typing import Any, Callable
+
+
+class ValidationError(Exception):
+    ''' Raised when a value doesn't match a compiled schema. '''
+    def __init__(self, errors: list[str], *args):
+        super().__init__('; '.join(errors), *args)
+        self.errors = errors
+
+
+Validator = Callable[[Any, str], Any]
+
+
+###############################################################################
+# Type coercion.
+#
+# Models occasionally send close-but-wrong values, such as numbers as strings
+# or a single item where a list is expected. These are coerced when the intent
+# is unambiguous. Anything else is reported as an error.
+###############################################################################
+def _string(value, path):
+    match value:
+        case str():
+            return value
+        case bool() | int() | float():
+            return str(value)
+        case dict() | list():
+            return json.dumps(value)
+    raise ValidationError([f'{path}: expected a string'])
+
+
+def _integer(value, path):
+    match value:
+        case bool():
+            pass
+        case int():
+            return value
+        case float() if value.is_integer():
+            return int(value)
+        case str():
+            try:
+                return int(value.strip())
+            except ValueError:
+                pass
+    raise ValidationError([f'{path}: expected an integer'])
+
+
+def _number(value, path):
+    match value:
+        case bool():
+            pass
+        case int() | float():
+            return value
+        case str():
+            try:
+                return float(value.strip())
+            except ValueError:
+                pass
+    raise ValidationError([f'{path}: expected a number'])
+
+
+def _boolean(value, path):
+    match value:
+        case bool():
+            return value
+        case str() if value.strip().lower() in ('true', 'false'):
+            return value.strip().lower() == 'true'
+    raise ValidationError([f'{path}: expected a boolean'])
+
+
+def _decoded(value, kind):
+    ''' Returns value decoded from JSON if it's a string holding the expected kind. '''
+    if isinstance(value, str):
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            return value
+        if isinstance(decoded, kind):
+            return decoded
+    return value
+
+
+###############################################################################
+# Schema compilation.
+###############################################################################
+def compile_schema(schema: dict) -> Validator:
+    ''' Compiles a JSON schema into a function that validates and coerces a value.
+
+    Supports the subset of JSON schema used by function tools: object, array,
+    string, integer, number and boolean types, along with properties, required,
+    items and enum. The returned function takes the value and a path used in
+    error messages, and returns the coerced value or raises ValidationError.
+    '''
+    match schema.get('type'):
+        case 'object':
+            validator = _compile_object(schema)
+        case 'array':
+            validator = _compile_array(schema)
+        case 'string':
+            validator = _string
+        case 'integer':
+            validator = _integer
+        case 'number':
+            validator = _number
+        case 'boolean':
+            validator = _boolean
+        case _:
+            validator = lambda value, path: value
+
+    if (enum := schema.get('enum')) is not None:
+        return _compile_enum(validator, enum)
+    return validator
+
+
+def _compile_enum(validator: Validator, enum: list) -> Validator:
+    lookup = {str(option).casefold(): option for option in enum}
+
+    def validate(value, path):
+        value = validator(value, path)
+        if value in enum:
+            return value
+        if isinstance(value, str) and (option := lookup.get(value.strip().casefold())) is not None:
+            return option
+        raise ValidationError([f'{path}: expected one of: {", ".join(map(str, enum))}'])
+    return validate
+
+
+def _compile_object(schema: dict) -> Validator:
+    properties = {name: compile_schema(prop) for name, prop in schema.get('properties', {}).items()}
+    required = schema.get('required', [])
+
+    def validate(value, path):
+        value = _decoded(value, dict)
+        if not isinstance(value, dict):
+            raise ValidationError([f'{path}: expected an object'])
+
+        errors = [f'{path}.{name}: is required' for name in required if value.get(name) is None]
+        result = {}
+        for name, item in value.items():
+            if name not in properties:
+                errors.append(f'{path}.{name}: is not a known property')
+            elif item is not None:
+                try:
+                    result[name] = properties[name](item, f'{path}.{name}')
+                except ValidationError as e:
+                    errors.extend(e.errors)
+
+        if errors:
+            raise ValidationError(errors)
+        return result
+    return validate
+
+
+def _compile_array(schema: dict) -> Validator:
+    items = compile_schema(schema.get('items', {}))
+
+    def validate(value, path):
+        value = _decoded(value, list)
+        if not isinstance(value, list):
+            # A lone item where a list is expected.
+            value = [value]
+
+        errors, result = [], []
+        for i, item in enumerate(value):
+            try:
+                result.append(items(item, f'{path}[{i}]'))
+            except ValidationError as e:
+                errors.extend(e.errors)
+
+        if errors:
+            raise ValidationError(errors)
+        return result
+    return validate
+
+
+def compile_tools(tools: list[dict]) -> dict[str, Validator]:
+    ''' Compiles the parameter schemas for each function tool, keyed by function name. '''
+    return {
+        tool['function']['name']: compile_schema(tool['function'].get('parameters', {'type': 'object'}))
+        for tool in tools
+        if tool.get('type') == 'function'
+    }
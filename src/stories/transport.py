@@ -0,0 +1,92 @@
+import json
+import threading
+
+import httpx
+from openai import OpenAI
+
+
+class Transport:
+    ''' Process-wide HTTP transport for the OpenAI clients.
+
+    API traffic (messages, runs, run polls, assistant updates) and media traffic
+    (image and audio generation) use separate connection pools, so small status
+    polls never wait on a free connection behind a large download. Each timeout
+    profile is a client view over one of those pools. Only run and step status
+    polls use the short polling timeouts; other API calls use the api profile.
+    '''
+    # Which connection pool each timeout profile uses.
+    pools = {
+        'api': 'api',
+        'polling': 'api',
+        'uploads': 'api',
+        'generation': 'media',
+    }
+
+    __shared: dict[str, 'Transport'] = {}
+    __lock = threading.Lock()
+
+    def __init__(self,
+        pools: dict[str, dict] = None,
+        timeouts: dict[str, dict] = None,
+        http2: bool = False,
+    ) -> None:
+        # Falls back to HTTP/1.1 when the h2 package is missing. InteractiveStories reports it.
+        self.http2_requested = http2
+        self.http2 = http2 and self.http2_available()
+        self.http_clients = {
+            pool: self.http_client((pools or {}).get(pool, {}), self.http2)
+            for pool in set(self.pools.values())
+        }
+        self.clients = {
+            profile: OpenAI(
+                http_client=self.http_clients[pool],
+                timeout=self.timeout((timeouts or {}).get(profile, {})),
+                # Retries are handled by the shared request governor.
+                max_retries=0,
+            )
+            for profile, pool in self.pools.items()
+        }
+
+    @staticmethod
+    def http2_available() -> bool:
+        try:
+            import h2
+            return True
+        except ImportError:
+            return False
+
+    @staticmethod
+    def http_client(limits: dict, http2: bool) -> httpx.Client:
+        return httpx.Client(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=limits.get('max_connections', 100),
+                max_keepalive_connections=limits.get('max_keepalive_connections', 20),
+                keepalive_expiry=limits.get('keepalive_expiry', 5.0),
+            ),
+        )
+
+    @staticmethod
+    def timeout(profile: dict) -> httpx.Timeout:
+        return httpx.Timeout(
+            connect=profile.get('connect', 5.0),
+            read=profile.get('read', 60.0),
+            write=profile.get('write', 60.0),
+            pool=profile.get('pool', 10.0),
+        )
+
+    def client(self, profile: str) -> OpenAI:
+        return self.clients[profile]
+
+    def close(self):
+        for http_client in self.http_clients.values():
+            http_client.close()
+
+    @classmethod
+    def shared(cls, **config) -> 'Transport':
+        ''' Returns the transport for this configuration, creating it on first use. '''
+        key = json.dumps(config, sort_keys=True)
+        with cls.__lock:
+            if key not in cls.__shared:
+                cls.__shared[key] = cls(**config)
+            return cls.__shared[key]
@@ -1,4 +1,8 @@
+import os
+import time
+
 from stories import app
+from stories.cassette import Cassette
 
 import streamlit as st
 
@@ -15,16 +19,54 @@ def update_session_name(session_id):
     story_app.sessions[session_id].name = st.session_state[f'{session_id}_name']
     story_app.save()
 
+def cull_sessions():
+    culled = st.session_state.cull_sessions
+    deleted = story_app.delete_sessions(*culled)
+    # Clear the selection, since the deleted sessions are no longer options.
+    st.session_state.cull_sessions = []
+    st.session_state.maintenance_result = f'Culled {len(deleted)} of {len(culled)} sessions.'
+
+def collect_assets():
+    try:
+        report = story_app.collect_assets()
+    except RuntimeError as e:
+        # Refused while prompts or jobs are running.
+        st.session_state.maintenance_warning = str(e)
+        return
+    st.session_state.maintenance_result = f'Removed {report["files"]} files, reclaiming {report["bytes"] / 1024 / 1024:.1f} MB.'
+
+def current_user():
+    # Only available when deployed with authentication.
+    try:
+        return st.experimental_user.email
+    except Exception:
+        return None
+
+def update_session_tier(session_id: str):
+    tier = st.session_state[f'model_tier_{session_id}']
+    story_app.set_session_tier(None if tier == 'auto' else tier, session_id)
+
 
 ###############################################################################
 # The Story App
 ###############################################################################
 @st.cache_resource
 def cached_story_app(pre_load=True):
-    story = app.InteractiveStories()
+    cassette = None
+    # Optionally record the API calls for the session, or replay them offline.
+    if path := os.getenv('STORIES_CASSETTE'):
+        cassette = Cassette(
+            path,
+            mode=os.getenv('STORIES_CASSETTE_MODE', 'replay'),
+            realtime=os.getenv('STORIES_CASSETTE_REALTIME', '').lower() in ('1', 'true'),
+        )
+
+    story = app.InteractiveStories(cassette=cassette)
     
     if pre_load:    
         story.load()
+    # Keep threads ready for new sessions.
+    story.warm_threads.start()
     return story
     
 
@@ -42,7 +84,7 @@ with st.sidebar:
     ###############################################################################
     # New Session
     ###############################################################################
-    st.button('New Session', use_container_width=True, on_click=story_app.activate_session)
+    st.button('New Session', use_container_width=True, on_click=story_app.activate_session, kwargs={'user': current_user()})
     ###############################################################################
     # Sessions
     ###############################################################################
@@ -70,6 +112,25 @@ with st.sidebar:
         with c:
             st.button('🗑️ Cull', key=cull_key, on_click=story_app.delete_session, args=(session.id, ))
 
+    ###############################################################################
+    # Bulk Cull
+    ###############################################################################
+    st.divider()
+    with st.expander('Maintenance'):
+        culled = st.multiselect(
+            'Sessions',
+            [session.id for session in story_app.sessions],
+            format_func=lambda id: story_app.sessions[id].friendly_name,
+            key='cull_sessions',
+        )
+        st.button('🗑️ Cull Selected', use_container_width=True, disabled=not culled, on_click=cull_sessions)
+        st.button('🧹 Collect Orphaned Assets', use_container_width=True, on_click=collect_assets)
+
+        if 'maintenance_result' in st.session_state:
+            st.success(st.session_state.pop('maintenance_result'))
+        if 'maintenance_warning' in st.session_state:
+            st.warning(st.session_state.pop('maintenance_warning'))
+
     ###############################################################################
     # Narrator Voice
     ###############################################################################
@@ -104,6 +165,18 @@ with st.sidebar:
     ###############################################################################
     st.divider()
     st.subheader('Assistant Settings')
+    if story_app.active_session is not None:
+        tiers = ['auto', *story_app.router.tiers]
+        current = story_app.active_session.tier
+        st.selectbox(
+            'Model Tier',
+            tiers,
+            index=tiers.index(current) if current in tiers else 0,
+            # Keyed by session, so switching sessions shows that session's tier.
+            key=f'model_tier_{story_app.activesess}',
+            on_change=update_session_tier,
+            args=(story_app.activesess,),
+        )
     st.button('Update', on_click=story_app.update_assistant, use_container_width=True)
 
 
@@ -116,42 +189,100 @@ with st.sidebar:
 # Chat Input
 ###############################################################################
 if (prompt := st.chat_input('What would you like to do?')):
-    story_app.prompt_and_wait(prompt)
+    story_app.submit_prompt(prompt)
+
+# Wait on the active run. Sending another prompt reruns the script, which
+# interrupts this loop and adds the prompt to the session's queue.
+if story_app.session_busy():
+    status = st.empty()
+    while story_app.session_busy():
+        status.caption(f'✍️ Writing... {story_app.queue_depth()} prompt(s) queued.')
+        time.sleep(0.5)
+    status.empty()
+
+if failed := story_app.pop_prompt_error():
+    error, dropped = failed
+    st.error(error)
+    if dropped:
+        st.warning('These prompts were not sent:\n\n' + '\n\n'.join(f'- {prompt}' for prompt in dropped))
 
 a, b, c = st.tabs(['Story', 'Entities', 'Developer Log'])
 ###############################################################################
 # Story Tab
 ###############################################################################
+# Fragments rerun on their own when their widgets change, so a narration click
+# doesn't rerun the whole page. Older Streamlit versions render them inline.
+fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None) or (lambda func: func)
+
+STORY_PAGE_SIZE = 20
+
+@st.cache_data(max_entries=200, show_spinner=False)
+def asset_content(path: str, version: int | None) -> bytes | None:
+    # Keyed by the version recorded when the asset was saved, so a regenerated
+    # file is read again without checking the file on every rerun.
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def media(assets: dict, name: str) -> bytes | None:
+    if (asset := assets.get(name)) is None:
+        return None
+    return asset_content(str(asset.path), asset.version)
+
+def show_older_messages():
+    st.session_state.story_shown = st.session_state.get('story_shown', STORY_PAGE_SIZE) + STORY_PAGE_SIZE
+
+@fragment
+def story_view():
+    # Start from the latest page whenever another session is opened.
+    if st.session_state.get('story_session') != story_app.activesess:
+        st.session_state.story_session = story_app.activesess
+        st.session_state.story_shown = STORY_PAGE_SIZE
+
+    # Runs add messages on background threads.
+    with story_app.state_lock:
+        messages = list(story_app.messages)
+    if not messages:
+        st.markdown(story_app.welcome())
+        return
+
+    # Only the most recent page of messages is rendered until older ones are requested.
+    shown = st.session_state.get('story_shown', STORY_PAGE_SIZE)
+    if len(messages) > shown:
+        st.button(f'⬆️ Show older messages ({len(messages) - shown} hidden)', on_click=show_older_messages, use_container_width=True)
+
+    for message in messages[-shown:]:
+        assets = story_app.message_assets(message.id)
+        narration, visualization = media(assets, 'narration'), media(assets, 'visualization')
+
+        with st.chat_message(message.role):
+            st.markdown(message.text)
+
+            if narration is not None:
+                st.audio(
+                    narration, 
+                    format='audio/opus'
+                )
+            else:
+                st.button(
+                    '🔊 Create Narration', 
+                    key=f'{message.id}_narration', 
+                    on_click=story_app.request_narration, 
+                    args=(message.id, message.text),
+                    kwargs={
+                        'voice': st.session_state.narrator_voice,
+                        'model': st.session_state.narrator_model,
+                    }
+                )
+                
+            if visualization is not None:
+                st.image(visualization)
+
 with a:
     try:
-        if not story_app.messages:
-            st.markdown(story_app.welcome())
-
-        for message in story_app.messages:
-            id, text, role = message.id, message.text, message.role
-
-            with st.chat_message(role):
-                st.markdown(text)
-
-                if narration := story_app.asset(id, 'narration'):
-                    st.audio(
-                        narration.content, 
-                        format='audio/opus'
-                    )
-                else:
-                    st.button(
-                        '🔊 Create Narration', 
-                        key=f'{id}_narration', 
-                        on_click=story_app.get_narration, 
-                        args=(id, text),
-                        kwargs={
-                            'voice': st.session_state.narrator_voice,
-                            'model': st.session_state.narrator_model,
-                        }
-                    )
-                    
-                if visualization := story_app.asset(id, 'visualization', 'png'):
-                    st.image(visualization.content)
+        story_view()
     except Exception as e:
         st.error(e)
     
@@ -162,7 +293,10 @@ with b:
     # Show the session info.
     st.markdown(story_app.sessinfo())
 
-    for entity in story_app.entities:
+    with story_app.state_lock:
+        entities = list(story_app.entities)
+
+    for entity in entities:
         st.divider()
         name, type, desc = entity.name, entity.type, entity.desc
         nkey, tkey, dkey = f'{name}_name', f'{name}_type', f'{name}_desc'
@@ -172,11 +306,15 @@ with b:
         st.text_area( 'Desc', desc, key=dkey)
 
         if st.button('Update', key=f'{name}_update'):
-            story_app.entities[name] = app.Entity(
+            updated = app.Entity(
                 name=st.session_state[nkey],
                 type=st.session_state[tkey],
                 desc=st.session_state[dkey],
+                # Aliases aren't editable here, so keep the ones the assistant set.
+                aliases=entity.aliases,
             )
+            with story_app.state_lock:
+                story_app.entities[name] = updated
             # Save the updated entity.
             story_app.save()
 
@@ -191,3 +329,10 @@ with c:
     # Display the formatted string.
     st.markdown(actions)
 
+    if story_app.active_session is not None:
+        st.subheader('Usage')
+        st.json(story_app.usage_summary())
+
+    st.subheader('API Requests')
+    st.json(story_app.request_metrics())
+
@@ -0,0 +1,181 @@
+from datetime import datetime, timezone
+import argparse
+import json
+import sqlite3
+import threading
+
+
+class BudgetExceeded(Exception):
+    ''' Raised instead of starting a run when a hard budget is exceeded. '''
+    def __init__(self, scope: str, spent: float, limit: float, *args):
+        super().__init__(f'The {scope} budget of ${limit:.2f} has been exceeded (${spent:.2f} spent).', *args)
+        self.scope = scope
+        self.spent = spent
+        self.limit = limit
+
+
+class UsageLedger:
+    ''' Records token, image and narration usage in SQLite.
+
+    Every call is stored as an event, and a daily rollup keyed by day, session,
+    user, kind and model is updated in the same transaction. Totals are read
+    from the rollup, so queries don't grow with the number of events.
+
+    Prices are in USD: per 1K prompt/completion tokens, per image, and per 1K
+    narrated characters. Images are recorded as 'model/quality/size', and fall
+    back to the model's price when that variant isn't listed.
+    '''
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS usage_events (
+            id INTEGER PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            day TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            model TEXT NOT NULL,
+            ref TEXT,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            units INTEGER NOT NULL DEFAULT 0,
+            cost REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            day TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            model TEXT NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            units INTEGER NOT NULL DEFAULT 0,
+            cost REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, session_id, user_id, kind, model)
+        );
+        CREATE INDEX IF NOT EXISTS usage_daily_session ON usage_daily (session_id);
+        CREATE INDEX IF NOT EXISTS usage_daily_user ON usage_daily (user_id, day);
+    '''
+
+    def __init__(self, database: str = 'usage.db', prices: dict[str, dict] = None, budgets: dict = None) -> None:
+        self.prices = prices or {}
+        self.budgets = budgets or {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(self.schema)
+
+    def cost(self, model: str, prompt_tokens: int = 0, completion_tokens: int = 0, images: int = 0, characters: int = 0) -> float:
+        price = self.prices.get(model) or self.prices.get(model.split('/')[0], {})
+        return (
+            prompt_tokens / 1000 * price.get('prompt', 0)
+            + completion_tokens / 1000 * price.get('completion', 0)
+            + images * price.get('image', 0)
+            + characters / 1000 * price.get('characters', 0)
+        )
+
+    def record(self, session_id: str, user_id: str, kind: str, model: str, ref: str = None, prompt_tokens: int = 0, completion_tokens: int = 0, units: int = 0) -> float:
+        ''' Records a usage event and returns its cost. '''
+        cost = self.cost(
+            model,
+            prompt_tokens,
+            completion_tokens,
+            images=units if kind == 'image' else 0,
+            characters=units if kind == 'tts' else 0,
+        )
+        now = datetime.now(timezone.utc)
+        day = now.date().isoformat()
+        user_id = user_id or 'anonymous'
+
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.execute(
+                    'INSERT INTO usage_events (created_at, day, session_id, user_id, kind, model, ref, prompt_tokens, completion_tokens, units, cost) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (now.isoformat(), day, session_id, user_id, kind, model, ref, prompt_tokens, completion_tokens, units, cost),
+                )
+                self.connection.execute(
+                    'INSERT INTO usage_daily (day, session_id, user_id, kind, model, events, prompt_tokens, completion_tokens, units, cost) '
+                    'VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?) '
+                    'ON CONFLICT (day, session_id, user_id, kind, model) DO UPDATE SET '
+                    'events = events + 1, '
+                    'prompt_tokens = prompt_tokens + excluded.prompt_tokens, '
+                    'completion_tokens = completion_tokens + excluded.completion_tokens, '
+                    'units = units + excluded.units, '
+                    'cost = cost + excluded.cost',
+                    (day, session_id, user_id, kind, model, prompt_tokens, completion_tokens, units, cost),
+                )
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+        return cost
+
+    def totals(self, session_id: str = None, user_id: str = None, day: str = None) -> dict[str, float]:
+        ''' Sums the rollup, optionally filtered by session, user and day. '''
+        filters = {'session_id': session_id, 'user_id': user_id, 'day': day}
+        where = [f'{column} = ?' for column, value in filters.items() if value is not None]
+        query = (
+            'SELECT COALESCE(SUM(events), 0), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0), '
+            'COALESCE(SUM(units), 0), COALESCE(SUM(cost), 0) FROM usage_daily'
+        )
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+
+        with self.lock:
+            row = self.connection.execute(query, [value for value in filters.values() if value is not None]).fetchone()
+        return dict(zip(('events', 'prompt_tokens', 'completion_tokens', 'units', 'cost'), row))
+
+    def breakdown(self, day: str = None, group_by: str = 'user_id') -> list[dict]:
+        ''' Returns totals grouped by user, session, kind or model, optionally for one day. '''
+        if group_by not in ('user_id', 'session_id', 'kind', 'model', 'day'):
+            raise ValueError(f'Unknown grouping: {group_by}')
+        query = f'SELECT {group_by}, SUM(events), SUM(prompt_tokens), SUM(completion_tokens), SUM(units), SUM(cost) FROM usage_daily'
+        args = []
+        if day is not None:
+            query += ' WHERE day = ?'
+            args.append(day)
+        query += f' GROUP BY {group_by} ORDER BY SUM(cost) DESC'
+
+        with self.lock:
+            rows = self.connection.execute(query, args).fetchall()
+        return [dict(zip((group_by, 'events', 'prompt_tokens', 'completion_tokens', 'units', 'cost'), row)) for row in rows]
+
+    def check_budget(self, session_id: str, user_id: str = None) -> str:
+        ''' Returns 'ok' or 'downgrade', or raises BudgetExceeded if a hard budget is exceeded.
+
+        User budgets only apply to signed-in users. Anonymous sessions would
+        otherwise share a single daily budget.
+        '''
+        totals = {'session': self.totals(session_id=session_id)['cost']}
+        if user_id is not None:
+            totals['user_daily'] = self.totals(user_id=user_id, day=datetime.now(timezone.utc).date().isoformat())['cost']
+
+        for scope, spent in totals.items():
+            if (limit := self.budgets.get(f'{scope}_hard')) is not None and spent >= limit:
+                raise BudgetExceeded(scope.replace('_', ' '), spent, limit)
+
+        for scope, spent in totals.items():
+            if (limit := self.budgets.get(f'{scope}_soft')) is not None and spent >= limit:
+                return 'downgrade'
+        return 'ok'
+
+    def close(self):
+        self.connection.close()
+
+
+def main(args: list[str] = None):
+    parser = argparse.ArgumentParser(description='Report usage and cost totals.')
+    parser.add_argument('--database', default='usage.db')
+    parser.add_argument('--day', help='An ISO date, such as 2024-01-31. Defaults to all days.')
+    parser.add_argument('--by', default='user_id', choices=['user_id', 'session_id', 'kind', 'model', 'day'])
+    args = parser.parse_args(args)
+
+    ledger = UsageLedger(args.database)
+    print(json.dumps(ledger.breakdown(args.day, args.by), indent=2))
+
+
+if __name__ == '__main__':
+    main()
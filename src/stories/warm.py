@@ -0,0 +1,76 @@
+from collections import deque
+import threading
+from typing import Callable
+
+from stories.assistant import AssistantsAPI
+
+
+class WarmThreads:
+    ''' A pool of pre-created, empty threads handed out to new sessions.
+
+    A background worker keeps the pool topped up to `size`, so taking a thread
+    doesn't wait on the API. Threads still in the pool are deleted on close.
+    Failures are reported through `log`, such as the app's action log.
+    '''
+
+    def __init__(self, assistants: AssistantsAPI, size: int = 3, refill_interval: float = 30.0, retry_interval: float = 10.0, log: Callable[[str], None] = print) -> None:
+        self.assistants = assistants
+        self.log = log
+        self.size = size
+        self.refill_interval = refill_interval
+        self.retry_interval = retry_interval
+        self.ids: deque[str] = deque()
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+        self.stopped = threading.Event()
+        self.worker = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def start(self):
+        if self.size <= 0 or self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self.refill, daemon=True)
+        self.worker.start()
+
+    def refill(self):
+        while not self.stopped.is_set():
+            delay = self.refill_interval
+            try:
+                while len(self.ids) < self.size and not self.stopped.is_set():
+                    thread_id = self.assistants.add_thread().id
+                    with self.lock:
+                        if not self.stopped.is_set():
+                            self.ids.append(thread_id)
+                            continue
+                    # Closed while the thread was being created.
+                    self.assistants.delete_thread(thread_id)
+            except Exception as e:
+                self.log(f'Failed to refill warm threads: {e}')
+                delay = self.retry_interval
+
+            self.wanted.wait(delay)
+            self.wanted.clear()
+
+    def take(self) -> str | None:
+        ''' Returns a pre-created thread id, or None if the pool is empty. '''
+        with self.lock:
+            thread_id = self.ids.popleft() if self.ids else None
+        self.wanted.set()
+        return thread_id
+
+    def close(self):
+        ''' Stops the worker and deletes the threads that were never handed out. '''
+        self.stopped.set()
+        self.wanted.set()
+        if self.worker is not None:
+            self.worker.join(timeout=5)
+
+        with self.lock:
+            ids, self.ids = list(self.ids), deque()
+        for thread_id in ids:
+            try:
+                self.assistants.delete_thread(thread_id)
+            except Exception as e:
+                self.log(f'Failed to delete warm thread: {thread_id}. Error: {e}')
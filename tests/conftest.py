@@ -0,0 +1,156 @@
+from base64 import b64encode
+from collections import deque
+from itertools import count
+from types import SimpleNamespace
+import json
+
+import httpx
+import openai
+import pytest
+
+from stories.app import InteractiveStories
+from stories.governor import governor
+
+
+def not_found(path: str):
+    return openai.NotFoundError('Not found', response=httpx.Response(404, request=httpx.Request('GET', f'https://api.openai.com/v1/{path}')), body=None)
+
+
+class FakeClient:
+    ''' The parts of the OpenAI client used by InteractiveStories.
+
+    Runs follow `script`, one step per run or tool output submission. A step is
+    a reply (str), a list of (function name, arguments) tool calls, or a dict of
+    run attributes, such as a failed status. Once the script is empty, runs reply
+    with 'The end.'
+    '''
+
+    def __init__(self) -> None:
+        self.ids = count()
+        self.threads: dict[str, list] = {}
+        self.runs: dict[str, SimpleNamespace] = {}
+        self.script: deque = deque()
+        self.run_args: list[dict] = []
+        self.tool_outputs: list[dict] = []
+        self.images_generated: list[dict] = []
+
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(
+                create=lambda **kwargs: SimpleNamespace(id=self.next_id('asst')),
+                retrieve=lambda id: SimpleNamespace(id=id),
+            ),
+            threads=SimpleNamespace(
+                create=self.create_thread,
+                delete=self.delete_thread,
+                messages=SimpleNamespace(
+                    list=self.list_messages,
+                    create=self.create_message,
+                    update=lambda message_id, thread_id, metadata: None,
+                ),
+                runs=SimpleNamespace(
+                    create=self.create_run,
+                    retrieve=lambda thread_id, run_id: self.runs[run_id],
+                    list=self.list_runs,
+                    submit_tool_outputs=self.submit_tool_outputs,
+                    cancel=lambda thread_id, run_id: self.runs[run_id],
+                ),
+            ),
+        )
+        self.images = SimpleNamespace(generate=self.generate_image)
+        self.audio = SimpleNamespace(speech=SimpleNamespace(create=lambda **kwargs: SimpleNamespace(content=b'OggS narration')))
+
+    def next_id(self, prefix: str) -> str:
+        return f'{prefix}-{next(self.ids)}'
+
+    def create_thread(self, **kwargs):
+        thread_id = self.next_id('thread')
+        self.threads[thread_id] = []
+        return SimpleNamespace(id=thread_id)
+
+    def delete_thread(self, thread_id: str):
+        if self.threads.pop(thread_id, None) is None:
+            raise not_found(f'threads/{thread_id}')
+        return SimpleNamespace(id=thread_id, deleted=True)
+
+    def list_messages(self, thread_id: str, order: str = 'asc', after: str = None, **kwargs):
+        messages = self.threads[thread_id]
+        if after is not None:
+            messages = messages[[message.id for message in messages].index(after) + 1:]
+        return list(messages)
+
+    def create_message(self, thread_id: str, role: str, content: str, metadata: dict = None):
+        message = SimpleNamespace(
+            id=self.next_id('msg'),
+            role=role,
+            content=[SimpleNamespace(type='text', text=SimpleNamespace(value=content))],
+            metadata=metadata or {},
+        )
+        self.threads[thread_id].append(message)
+        return message
+
+    def list_runs(self, thread_id: str, order: str = 'asc', limit: int = 20, **kwargs):
+        runs = [run for run in self.runs.values() if run.thread_id == thread_id]
+        return (runs[::-1] if order == 'desc' else runs)[:limit]
+
+    def create_run(self, thread_id: str, assistant_id: str, **kwargs):
+        self.run_args.append(kwargs)
+        run = SimpleNamespace(
+            id=self.next_id('run'),
+            thread_id=thread_id,
+            model=kwargs.get('model', 'gpt-3.5-turbo-1106'),
+            usage=None,
+            last_error=None,
+        )
+        self.runs[run.id] = run
+        return self.advance(run)
+
+    def submit_tool_outputs(self, thread_id: str, run_id: str, tool_outputs: list[dict]):
+        self.tool_outputs.extend(tool_outputs)
+        return self.advance(self.runs[run_id])
+
+    def advance(self, run):
+        step = self.script.popleft() if self.script else 'The end.'
+        if isinstance(step, list):
+            run.status = 'requires_action'
+            run.required_action = SimpleNamespace(
+                type='submit_tool_outputs',
+                submit_tool_outputs=SimpleNamespace(tool_calls=[
+                    SimpleNamespace(id=self.next_id('call'), function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+                    for name, arguments in step
+                ]),
+            )
+        elif isinstance(step, dict):
+            vars(run).update(step)
+        else:
+            self.create_message(run.thread_id, 'assistant', step)
+            run.status = 'completed'
+            run.usage = SimpleNamespace(prompt_tokens=1000, completion_tokens=100)
+        return run
+
+    def generate_image(self, **kwargs):
+        self.images_generated.append(kwargs)
+        image = {'b64_json': b64encode(b'\x89PNG image').decode(), 'revised_prompt': kwargs['prompt']}
+        return SimpleNamespace(data=[SimpleNamespace(revised_prompt=image['revised_prompt'], model_dump=lambda: image)])
+
+
+@pytest.fixture(autouse=True)
+def fresh_governor(monkeypatch):
+    # The governor is shared by the whole process. Clearing its settings makes the
+    # next InteractiveStories reset it, so each test starts with full buckets.
+    monkeypatch.setattr(governor, 'settings', None)
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+@pytest.fixture
+def stories(tmp_path, monkeypatch, client):
+    ''' An InteractiveStories instance with an active session, backed by the fake client. '''
+    # The save file, usage database and assets are written to the working directory.
+    monkeypatch.chdir(tmp_path)
+    stories = InteractiveStories(client=client)
+    stories.storybotid = stories.create_assistant()
+    stories.activate_session()
+    return stories
@@ -0,0 +1,208 @@
+from types import SimpleNamespace
+import json
+import os
+
+import pytest
+
+from stories.app import InteractiveStories
+from stories.assistant import RunError
+from stories.usage import BudgetExceeded
+
+
+def test_batched_entity_functions(stories):
+    session_id = stories.activesess
+    result = stories.set_entity_bios([
+        {'type': 'character', 'name': 'Alice', 'desc': 'curious', 'aliases': ['Al']},
+        {'type': 'location', 'name': 'Mars', 'desc': 'red'},
+    ], session_id=session_id)
+    assert result == 'Set 2 entities: Alice,Mars'
+
+    assert stories.get_entity_bios(['Alice', 'Mars', 'Zed'], session_id=session_id).splitlines() == [
+        'Alice (character) | curious',
+        'Mars (location) | red',
+        'Zed | Not found.',
+    ]
+
+    stories.set_story_config('space', 'short chapters', session_id=session_id)
+    state = json.loads(stories.get_story_state(session_id=session_id))
+    assert (state['theme'], state['guidelines']) == ('space', 'short chapters')
+    assert [entity['name'] for entity in state['entities']] == ['Alice', 'Mars']
+
+
+def test_tool_calls_are_validated_and_dispatched(stories, client):
+    client.script.extend([
+        [
+            ('set_entity_bio', {'type': 'character', 'name': 'Alice', 'desc': 'curious'}),
+            ('get_entity_bio', {}),
+            ('launch_rocket', {}),
+        ],
+        'Alice waves.',
+    ])
+    stories.prompt_and_wait('Begin')
+
+    assert str(stories.entities.find('Alice')) == 'Alice (character) | curious'
+    # Bad calls are reported back to the assistant rather than cancelling the run.
+    outputs = [output['output'] for output in client.tool_outputs]
+    assert outputs[0] == 'Entity: Alice of type: character set to: curious'
+    assert json.loads(outputs[1])['error']['type'] == 'invalid_arguments'
+    assert json.loads(outputs[2])['error']['type'] == 'unknown_function'
+    assert len([action for action in stories.action_log if action.startswith('Function call failed')]) == 2
+    assert [message.text for message in stories.messages] == ['Begin', 'Alice waves.']
+
+
+def test_runs_use_the_routed_tier(stories, client):
+    session_id = stories.activesess
+    # Setup prompts go to the fast tier.
+    stories.prompt_and_wait('Let us begin a long and winding story')
+    stories.set_story_config('space', 'short chapters', session_id=session_id)
+    # Prompts that match no rule keep the assistant's model.
+    stories.prompt_and_wait('Describe the spaceship in great detail please')
+    stories.set_session_tier('quality', session_id)
+    stories.prompt_and_wait('Go')
+
+    assert [args.get('model') for args in client.run_args] == ['gpt-3.5-turbo-1106', None, 'gpt-4-1106-preview']
+
+
+def test_tool_calls_act_on_the_run_session(stories, client):
+    first = stories.activesess
+    stories.activate_session()
+    # The run finishes after another session was activated.
+    client.script.append([('set_entity_bio', {'type': 'character', 'name': 'Alice', 'desc': 'curious'})])
+    stories.prompt_and_wait('Begin', session_id=first)
+
+    assert stories.sessions[first].entities.find('Alice') is not None
+    assert not list(stories.entities)
+
+
+def test_failed_runs_drop_queued_prompts(stories, client):
+    from stories.prompts import PromptQueue
+
+    session_id = stories.activesess
+    queue = stories.queues[session_id] = PromptQueue(coalesce=False)
+    queue.put('one')
+    queue.put('two')
+    client.script.append({'status': 'failed', 'last_error': SimpleNamespace(code='server_error', message='boom')})
+    stories.drain_prompts(session_id, queue)
+
+    error, dropped = stories.pop_prompt_error()
+    assert isinstance(error, RunError)
+    assert dropped == ['two']
+    assert stories.queue_depth() == 0
+    assert stories.pop_prompt_error() is None
+
+
+def test_delete_sessions(stories, client):
+    first = stories.activesess
+    stories.activate_session()
+    gone = stories.activesess
+    stories.activate_session()
+    busy = stories.activesess
+    # Already deleted elsewhere; only the local session remains.
+    del client.threads[gone]
+    stories.prompt_queue(busy).put('Still writing')
+
+    assert stories.delete_sessions(first, gone, busy) == [first, gone]
+    assert [session.id for session in stories.sessions] == [busy]
+    with pytest.raises(Exception, match='is busy'):
+        stories.delete_session(busy)
+
+
+def test_collect_assets_keeps_referenced_and_recent_files(stories, tmp_path):
+    session = stories.active_session
+    stories.get_narration('msg-1', 'Hello', session_id=session.id)
+    (tmp_path / 'assets' / 'orphan.png').write_bytes(b'old')
+    (tmp_path / 'assets' / 'fresh.png').write_bytes(b'new')
+    os.utime(tmp_path / 'assets' / 'orphan.png', (0, 0))
+    os.utime(tmp_path / 'assets' / 'msg-1-narration.opus', (0, 0))
+
+    assert stories.collect_assets(dry_run=True) == {'files': 1, 'bytes': 3}
+    assert (tmp_path / 'assets' / 'orphan.png').exists()
+    assert stories.collect_assets() == {'files': 1, 'bytes': 3}
+    assert sorted(path.name for path in (tmp_path / 'assets').iterdir()) == ['fresh.png', 'msg-1-narration.opus']
+
+    stories.prompt_queue().put('Still writing')
+    with pytest.raises(RuntimeError, match='collected while prompts'):
+        stories.collect_assets()
+
+
+def test_failed_runs_without_an_error_record_usage(stories, client):
+    client.script.append({'status': 'expired', 'usage': SimpleNamespace(prompt_tokens=1000, completion_tokens=0)})
+    with pytest.raises(RunError):
+        stories.prompt_and_wait('Begin')
+
+    assert stories.usage.totals(session_id=stories.activesess)['prompt_tokens'] == 1000
+    assert 'Run failed: expired.' in stories.action_log
+
+
+def test_budgets_are_off_by_default(stories):
+    stories.usage.record(stories.activesess, None, 'image', 'dall-e-3', units=1000)
+    stories.prompt_and_wait('Go')
+
+
+def test_budgets_downgrade_then_reject_runs(stories, client):
+    session_id = stories.activesess
+    stories.usage.budgets.update(session_soft=1.0, session_hard=5.0)
+    stories.set_story_config('space', 'short chapters', session_id=session_id)
+    stories.set_session_tier('quality', session_id)
+    stories.usage.record(session_id, None, 'image', 'dall-e-3', units=25)
+    stories.prompt_and_wait('Go')
+    # Over the soft budget, runs use the downgrade tier.
+    assert client.run_args[-1]['model'] == 'gpt-3.5-turbo-1106'
+
+    stories.usage.record(session_id, None, 'image', 'dall-e-3', units=100)
+    with pytest.raises(BudgetExceeded):
+        stories.prompt_and_wait('Go on')
+    # Nothing was added to the thread.
+    assert [message.text for message in stories.messages] == ['Go', 'The end.']
+
+
+def test_images_are_priced_by_quality_and_size(stories, client):
+    session_id = stories.activesess
+    stories.prompt_and_wait('Begin')
+    stories.image_args.quality, stories.image_args.size = 'hd', '1792x1024'
+    stories.get_generated_image('A red planet', session_id=session_id)
+
+    assert client.images_generated[0]['quality'] == 'hd'
+    assert stories.usage.breakdown(group_by='model')[0] == pytest.approx({
+        'model': 'dall-e-3/hd/1792x1024', 'events': 1, 'prompt_tokens': 0, 'completion_tokens': 0, 'units': 1, 'cost': 0.12,
+    })
+
+
+def test_assets_record_their_version_when_saved(stories, tmp_path):
+    session_id = stories.activesess
+    stories.get_narration('msg-1', 'Hello', session_id=session_id)
+    asset = stories.message_assets('msg-1')['narration']
+    first = asset.version
+    assert first is not None
+
+    # A regenerated file gets a new version, which survives a reload.
+    stories.get_narration('msg-1', 'Hello again', session_id=session_id)
+    asset = stories.message_assets('msg-1')['narration']
+    assert asset.version > first
+
+    reloaded = InteractiveStories(client=stories.client)
+    reloaded.load()
+    assert reloaded.sessions[session_id].assets.for_message('msg-1')['narration'].version == asset.version
+
+
+def test_new_instances_keep_the_shared_governor_state(stories):
+    from stories.governor import governor
+
+    stories.prompt_and_wait('Begin')
+    metrics = governor.metrics()
+    assert metrics['runs']['calls'] >= 1
+
+    InteractiveStories(client=stories.client)
+    assert governor.metrics() == metrics
+
+
+def test_only_close_matches_are_suggested(stories):
+    session_id = stories.activesess
+    stories.set_entity_bios([
+        {'type': 'character', 'name': 'Alice Liddell', 'desc': 'curious'},
+        {'type': 'character', 'name': 'White Rabbit', 'desc': 'late'},
+    ], session_id=session_id)
+    assert stories.get_entity_bio('Alice Lidel', session_id=session_id) == 'Alice Liddell (character) | curious'
+    assert stories.get_entity_bio('Liddel', session_id=session_id) == 'Liddel | Not found. Did you mean: Alice Liddell?'
+    # Shares a trigram with 'White Rabbit', but isn't close to it.
+    assert stories.get_entity_bio('Hitchhiker', session_id=session_id) == 'Hitchhiker | Not found.'
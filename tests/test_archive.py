@@ -0,0 +1,157 @@
+from itertools import count
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from stories.app import Asset, Entity, Session, Sessions
+from stories.archive import ImportProgress, export_sessions, import_sessions
+
+
+def api_message(id, role, text, metadata=None):
+    return SimpleNamespace(
+        id=id,
+        role=role,
+        content=[SimpleNamespace(type='text', text=SimpleNamespace(value=text))],
+        metadata=metadata or {},
+    )
+
+
+class FakeAssistants:
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self.ids = count()
+        self.threads: dict[str, list] = {}
+        self.deleted: list[str] = []
+
+    def messages(self, thread_id: str):
+        return list(self.threads.get(thread_id, []))
+
+    def add_thread(self):
+        thread_id = f'{self.prefix}-thread-{next(self.ids)}'
+        self.threads[thread_id] = []
+        return SimpleNamespace(id=thread_id)
+
+    def delete_thread(self, thread_id: str):
+        self.deleted.append(thread_id)
+        self.threads.pop(thread_id, None)
+
+    def add_message(self, thread_id: str, role: str, content: str, **kwargs):
+        message = api_message(f'{self.prefix}-msg-{next(self.ids)}', role, content, kwargs.get('metadata'))
+        self.threads[thread_id].append(message)
+        return message
+
+
+class FakeStories:
+    ''' The parts of InteractiveStories used by the archive. '''
+
+    def __init__(self, asset_dir) -> None:
+        self.asset_dir = str(asset_dir)
+        self.assistants = FakeAssistants(asset_dir.parent.name)
+        self.sessions = Sessions()
+        self.saves = 0
+
+    def log_action(self, action: str):
+        pass
+
+    def save(self):
+        self.saves += 1
+
+
+@pytest.fixture
+def source(tmp_path):
+    asset_dir = tmp_path / 'source' / 'assets'
+    asset_dir.mkdir(parents=True)
+    stories = FakeStories(asset_dir)
+
+    session = Session('thread-1', name='Moon', theme='space', guidelines='short', assets_dir=stories.asset_dir, tier='fast', user='a@example.com')
+    session.entities.add(Entity('character', 'Alice', 'curious', ['Al']))
+    stories.assistants.threads['thread-1'] = [
+        api_message('msg-1', 'user', 'Begin', {'type': 'prompt'}),
+        api_message('msg-2', 'assistant', 'Once upon a time', {'type': 'narrative'}),
+    ]
+    asset = Asset('msg-2', 'visualization', 'png', data=b'\x89PNG image', base=stories.asset_dir)
+    asset.save()
+    session.assets.add(asset)
+    stories.sessions.add(session)
+    return stories
+
+
+@pytest.fixture
+def target(tmp_path):
+    asset_dir = tmp_path / 'target' / 'assets'
+    asset_dir.mkdir(parents=True)
+    return FakeStories(asset_dir)
+
+
+def test_export_import_round_trip(tmp_path, source, target):
+    path = str(tmp_path / 'stories.tar')
+    assert export_sessions(source, path) == 1
+    assert import_sessions(target, path) == 1
+
+    session = target.sessions.first
+    assert session.id != 'thread-1'
+    assert (session.name, session.theme, session.guidelines, session.tier, session.user) == ('Moon', 'space', 'short', 'fast', 'a@example.com')
+    assert [entity.as_dict for entity in session.entities] == [{'type': 'character', 'name': 'Alice', 'desc': 'curious', 'aliases': ['Al']}]
+
+    messages = target.assistants.threads[session.id]
+    assert [(message.role, message.content[0].text.value) for message in messages] == [('user', 'Begin'), ('assistant', 'Once upon a time')]
+
+    # The asset follows its message to the new message id.
+    asset = session.assets.for_message(messages[1].id)['visualization']
+    assert asset.content == b'\x89PNG image'
+
+
+def test_import_keeps_threads(tmp_path, source, target):
+    path = str(tmp_path / 'stories.tar')
+    export_sessions(source, path)
+    assert import_sessions(target, path, recreate_threads=False) == 1
+
+    session = target.sessions['thread-1']
+    assert not target.assistants.threads
+    assert session.assets.for_message('msg-2')['visualization'].content == b'\x89PNG image'
+
+
+def test_reimport_skips_imported_sessions(tmp_path, source, target):
+    path = str(tmp_path / 'stories.tar')
+    export_sessions(source, path)
+    import_sessions(target, path)
+    assert import_sessions(target, path) == 0
+    assert len(target.sessions) == 1
+
+
+def test_resume_deletes_threads_of_unsaved_sessions(tmp_path, source, target):
+    path = str(tmp_path / 'stories.tar')
+    export_sessions(source, path)
+    # An earlier run created a thread, then stopped before saving the session.
+    ImportProgress(f'{path}.progress').add_thread('thread-1', 'orphan')
+
+    assert import_sessions(target, path) == 1
+    assert target.assistants.deleted == ['orphan']
+
+
+@pytest.mark.parametrize('message_id, name', [('../../escape', 'visualization'), ('msg-2', '../escape'), ('msg-2', 'a/b')])
+def test_unsafe_asset_names_are_skipped(tmp_path, source, target, message_id, name):
+    session = source.sessions['thread-1']
+    session.assets.add(Asset(message_id, name, 'png', base=source.asset_dir))
+    path = str(tmp_path / 'stories.tar')
+    export_sessions(source, path)
+    import_sessions(target, path, recreate_threads=False)
+
+    assert [asset.name for asset in target.sessions['thread-1'].assets] == ['visualization']
+    assert not any(tmp_path.rglob('escape*'))
+
+
+def test_resume_keeps_sessions_saved_before_their_progress(tmp_path, source, target):
+    path = str(tmp_path / 'stories.tar')
+    export_sessions(source, path)
+    import_sessions(target, path)
+    thread_id = target.sessions.first.id
+    # The import stopped after saving the session, before its progress was committed.
+    with open(f'{path}.progress', 'w') as f:
+        f.write(json.dumps({'source': 'thread-1', 'thread': thread_id}) + '\n')
+
+    assert import_sessions(target, path) == 0
+    assert target.assistants.deleted == []
+    assert [session.id for session in target.sessions] == [thread_id]
+    assert 'thread-1' in ImportProgress(f'{path}.progress')
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import openai
+from openai.types.beta import Thread
+from openai.types.beta.threads import Run
+import pytest
+
+from conftest import not_found
+from stories.assistant import RunError
+from stories.cassette import Cassette, RecordedError
+from stories.governor import CircuitOpenError
+
+
+class FakeAssistants:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def thread(self, id: str):
+        self.calls += 1
+        return Thread(id=id, created_at=0, metadata={'n': str(self.calls)}, object='thread')
+
+    def delete_thread(self, thread_id: str):
+        raise not_found(f'threads/{thread_id}')
+
+    def add_run(self, thread_id: str, assistant_id: str):
+        raise CircuitOpenError('runs', 12.5)
+
+    def cancel_run(self, thread_id: str, run_id: str):
+        raise RunError(Run(
+            id=run_id, assistant_id='asst-1', created_at=0, instructions='', model='gpt-4',
+            object='thread.run', parallel_tool_calls=True, status='expired', thread_id=thread_id, tools=[],
+        ))
+
+
+class FakeStories:
+    ''' The parts of InteractiveStories a cassette is installed on. '''
+
+    def __init__(self) -> None:
+        self.assistants = FakeAssistants()
+        self.image_generator = lambda client, prompt: None
+        self.audio_generator = lambda client, prompt: SimpleNamespace(content=b'OggS ' + prompt.encode())
+        self.action_log = []
+
+    def log_action(self, action: str):
+        self.action_log.append(action)
+
+
+def calls(stories) -> list:
+    ''' Makes the same calls against live or replayed APIs, returning the results and the errors raised. '''
+    results = [stories.assistants.thread('thread-1'), stories.assistants.thread('thread-1')]
+    for call in (
+        lambda: stories.assistants.delete_thread('gone'),
+        lambda: stories.assistants.add_run('thread-1', 'asst-1'),
+        lambda: stories.assistants.cancel_run('thread-1', 'run-1'),
+    ):
+        with pytest.raises(Exception) as error:
+            call()
+        results.append(error.value)
+    results.append(stories.audio_generator(None, 'Hello').content)
+    return results
+
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / 'session.jsonl.gz')
+    cassette = Cassette(path, mode='record')
+    live = calls(cassette.install(FakeStories()))
+    cassette.close()
+
+    stories = Cassette(path).install(FakeStories())
+    replayed = calls(stories)
+    assert stories.assistants.target.calls == 0
+
+    # Repeated calls replay each recorded response in turn.
+    assert [thread.metadata for thread in replayed[:2]] == [{'n': '1'}, {'n': '2'}]
+    assert replayed[:2] == live[:2]
+
+    # Errors come back as their original classes.
+    not_found, circuit_open, run_error = replayed[2:5]
+    assert isinstance(not_found, openai.NotFoundError)
+    assert (not_found.status_code, str(not_found)) == (404, str(live[2]))
+    assert isinstance(circuit_open, CircuitOpenError)
+    assert (circuit_open.family, circuit_open.retry_in, str(circuit_open)) == ('runs', 12.5, str(live[3]))
+
+    assert isinstance(run_error, RunError)
+    assert run_error.run.status == 'expired'
+
+    assert replayed[5] == b'OggS Hello'
+
+
+def test_unknown_error_classes_replay_as_recorded_errors(tmp_path):
+    path = str(tmp_path / 'session.jsonl.gz')
+    cassette = Cassette(path, mode='record')
+    cassette.append({'name': 'thread', 'key': '["thread",[],{}]', 'error': {'type': 'Gone', 'class': 'missing.module:Gone', 'message': 'gone'}, 'elapsed': 0})
+    cassette.close()
+
+    with pytest.raises(RecordedError, match='Gone: gone'):
+        Cassette(path).replay_call('thread', (), {})
+
+
+def test_truncated_cassettes_replay_up_to_the_cut(tmp_path):
+    path = tmp_path / 'session.jsonl.gz'
+    cassette = Cassette(str(path), mode='record')
+    stories = cassette.install(FakeStories())
+    stories.assistants.thread('thread-1')
+    cassette.close()
+    # A recording that stopped without closing has no gzip trailer.
+    path.write_bytes(path.read_bytes()[:-8])
+
+    stories = Cassette(str(path)).install(FakeStories())
+    assert stories.assistants.thread('thread-1').metadata == {'n': '1'}
+    assert any('is truncated after 1 calls' in action for action in stories.action_log)
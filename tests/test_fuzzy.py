@@ -0,0 +1,54 @@
+from stories.fuzzy import NameIndex, normalize
+
+
+def test_normalize():
+    assert normalize('  Ａlice—Liddell! ') == 'alice liddell'
+    assert normalize('Chloé') == 'chloe'
+    assert normalize(None) == ''
+
+
+def test_exact_matches_ignore_case_accents_and_punctuation():
+    index = NameIndex()
+    index.add('Alice Liddell', 'Al')
+    assert index.exact('alice  liddell') == 'Alice Liddell'
+    assert index.exact('AL.') == 'Alice Liddell'
+    assert index.exact('Alcie') is None
+
+
+def test_ambiguous_exact_matches_resolve_to_nothing():
+    index = NameIndex()
+    index.add('The Queen', 'Queen')
+    index.add('Queen', 'Red Queen')
+    assert index.exact('queen') is None
+
+
+def test_candidates_rank_typos():
+    index = NameIndex()
+    index.add('Alice Liddell')
+    index.add('Mad Hatter', 'Hatter')
+    index.add('White Rabbit')
+    assert index.candidates('Alcie')[0][0] == 'Alice Liddell'
+    assert index.best('hattr') == 'Mad Hatter'
+    assert index.best('Cheshire Cat') is None
+
+
+def test_readding_replaces_aliases():
+    index = NameIndex()
+    index.add('Alice', 'Al')
+    index.add('Alice', 'Ally')
+    assert index.exact('al') is None
+    assert index.exact('ally') == 'Alice'
+
+    index.remove('Alice')
+    assert len(index) == 0
+    assert index.candidates('Alice') == []
+    assert not index.grams
+
+
+def test_candidates_below_the_minimum_score_are_left_out():
+    index = NameIndex()
+    index.add('Alice Liddell')
+    index.add('Mad Hatter')
+    assert [key for key, _ in index.candidates('Alice Hatter', min_score=0.25)] == ['Mad Hatter', 'Alice Liddell']
+    assert [key for key, _ in index.candidates('Lid')] == ['Alice Liddell']
+    assert index.candidates('Lid', min_score=0.25) == []
@@ -0,0 +1,191 @@
+import httpx
+import openai
+import pytest
+
+from stories.governor import CircuitBreaker, CircuitOpenError, RequestGovernor, TokenBucket
+
+
+REQUEST = httpx.Request('POST', 'https://api.openai.com/v1/threads')
+
+
+def server_error():
+    return openai.InternalServerError('boom', response=httpx.Response(500, request=REQUEST), body=None)
+
+
+def rate_limited():
+    return openai.RateLimitError('slow down', response=httpx.Response(429, request=REQUEST), body=None)
+
+
+def connect_error():
+    error = openai.APIConnectionError(request=REQUEST)
+    error.__cause__ = httpx.ConnectError('refused')
+    return error
+
+
+def read_timeout():
+    error = openai.APITimeoutError(REQUEST)
+    error.__cause__ = httpx.ReadTimeout('timed out')
+    return error
+
+
+def failing(*errors):
+    ''' Raises each error in turn, then returns 'ok'. Records every call. '''
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+    return func, calls
+
+
+@pytest.fixture
+def governor():
+    return RequestGovernor(max_retries=2, backoff_base=0, backoff_max=0, failure_threshold=3, reset_timeout=60)
+
+
+@pytest.mark.parametrize('error', [server_error, rate_limited, connect_error, read_timeout])
+def test_idempotent_calls_retry_transient_errors(governor, error):
+    func, calls = failing(error(), error())
+    assert governor.call('messages', func) == 'ok'
+    assert len(calls) == 3
+    assert governor.metrics()['messages']['retries'] == 2
+
+
+@pytest.mark.parametrize('error', [rate_limited, connect_error])
+def test_non_idempotent_calls_retry_unsent_requests(governor, error):
+    func, calls = failing(error())
+    assert governor.call('runs', func, idempotent=False) == 'ok'
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize('error', [server_error, read_timeout])
+def test_non_idempotent_calls_dont_retry_requests_that_may_have_applied(governor, error):
+    func, calls = failing(error())
+    with pytest.raises(openai.APIError):
+        governor.call('runs', func, idempotent=False)
+    assert len(calls) == 1
+
+
+def test_client_errors_are_not_retried(governor):
+    error = openai.BadRequestError('bad', response=httpx.Response(400, request=REQUEST), body=None)
+    func, calls = failing(error)
+    with pytest.raises(openai.BadRequestError):
+        governor.call('messages', func)
+    assert len(calls) == 1
+    assert governor.breaker('messages').state == 'closed'
+
+
+def test_retries_stop_after_max_retries(governor):
+    func, calls = failing(*[server_error() for _ in range(5)])
+    with pytest.raises(openai.InternalServerError):
+        governor.call('messages', func)
+    assert len(calls) == 3
+    assert governor.metrics()['messages']['errors'] == 1
+
+
+def test_outages_open_the_circuit(governor):
+    func, calls = failing(*[server_error() for _ in range(5)])
+    with pytest.raises(openai.InternalServerError):
+        governor.call('messages', func)
+    # The third consecutive failure reached the threshold.
+    assert governor.breaker('messages').state == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        governor.call('messages', func)
+    assert len(calls) == 3
+    assert governor.metrics()['messages']['rejected'] == 1
+
+
+def test_rate_limits_dont_open_the_circuit(governor):
+    func, calls = failing(*[rate_limited() for _ in range(3)])
+    with pytest.raises(openai.RateLimitError):
+        governor.call('messages', func)
+    assert governor.breaker('messages').state == 'closed'
+
+
+def test_breaker_transitions(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('stories.governor.time.monotonic', lambda: now[0])
+    breaker = CircuitBreaker(threshold=2, reset_timeout=10)
+
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.allow() == 10
+
+    now[0] += 10
+    assert breaker.state == 'half_open'
+    # Only one trial call is let through.
+    assert breaker.allow() == 0
+    assert breaker.allow() > 0
+
+    # A failed trial reopens the circuit straight away.
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    now[0] += 10
+    assert breaker.allow() == 0
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow() == 0
+
+
+def test_unreported_trials_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('stories.governor.time.monotonic', lambda: now[0])
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10)
+    breaker.record_failure()
+
+    now[0] += 10
+    assert breaker.allow() == 0
+    now[0] += 4
+    assert breaker.allow() == 6
+    # The trial never recorded a result, so another one is let through.
+    now[0] += 6
+    assert breaker.allow() == 0
+
+
+def test_token_bucket_reservations(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr('stories.governor.time.monotonic', lambda: now[0])
+    bucket = TokenBucket(rate=2, burst=2)
+
+    assert bucket.reserve(timeout=1) == 0
+    assert bucket.reserve(timeout=1) == 0
+    # Empty: the next token arrives in half a second.
+    assert bucket.reserve(timeout=1) == pytest.approx(0.5)
+    # Past the timeout, nothing is reserved.
+    assert bucket.reserve(timeout=0.5) == pytest.approx(-1.0)
+
+
+def test_retry_after_sets_the_minimum_backoff(governor):
+    governor.configure(backoff_base=0, backoff_max=30)
+    response = httpx.Response(429, request=REQUEST, headers={'retry-after-ms': '1500'})
+    error = openai.RateLimitError('slow down', response=response, body=None)
+    assert governor.backoff(0, error) == 1.5
+
+
+def test_limits_are_split_between_processes():
+    governor = RequestGovernor(limits={'default': {'rate': 4.0, 'burst': 8}, 'images': {'rate': 0.1, 'burst': 2}}, processes=4)
+    runs, images = governor.bucket('runs'), governor.bucket('images')
+    assert (runs.rate, runs.burst) == (1.0, 2.0)
+    # Every process can still make at least one call at once.
+    assert (images.rate, images.burst) == (0.025, 1)
+
+
+def test_reconfiguring_with_the_same_settings_keeps_state(governor):
+    settings = dict(max_retries=2, backoff_base=0, backoff_max=0, failure_threshold=3, reset_timeout=60)
+    func, _ = failing(*[server_error()] * 3)
+    with pytest.raises(openai.InternalServerError):
+        governor.call('runs', func)
+    assert governor.metrics()['runs']['circuit'] == 'open'
+
+    governor.configure(**settings)
+    assert governor.metrics()['runs']['circuit'] == 'open'
+    assert governor.metrics()['runs']['calls'] == 3
+
+    governor.configure(**{**settings, 'reset_timeout': 30})
+    assert governor.metrics() == {}
@@ -0,0 +1,216 @@
+import threading
+import time
+
+import pytest
+
+from stories.app import Asset, Entity, Session
+from stories.jobs import JobQueue, run_job, session_delta
+
+
+@pytest.fixture
+def database(tmp_path):
+    return str(tmp_path / 'jobs.db')
+
+
+@pytest.fixture
+def queue(database):
+    return JobQueue(database, poll_interval=0.01, heartbeat_timeout=0.2, wait_timeout=5)
+
+
+def test_jobs_are_claimed_oldest_first(queue):
+    ids = [queue.submit('prompt', f'session-{i}', {'n': i}) for i in range(3)]
+    queue.beat('worker')
+    assert [queue.claim('worker')['id'] for _ in range(3)] == ids
+    assert queue.claim('worker') is None
+
+
+def test_one_job_per_session_runs_at_a_time(queue):
+    first = queue.submit('prompt', 'a', {})
+    second = queue.submit('prompt', 'a', {})
+    other = queue.submit('prompt', 'b', {})
+    queue.beat('w1')
+    queue.beat('w2')
+
+    assert queue.claim('w1')['id'] == first
+    # The second prompt for session a waits behind the first.
+    assert queue.claim('w2')['id'] == other
+    assert queue.claim('w2') is None
+
+    assert queue.finish(first, 'w1', result={})
+    assert queue.claim('w2')['id'] == second
+
+
+def test_concurrent_claims_are_exclusive(database, queue):
+    ids = {queue.submit('prompt', f'session-{i}', {}) for i in range(40)}
+    claimed, lock = [], threading.Lock()
+
+    def worker(name):
+        # Each worker process has its own connection.
+        own = JobQueue(database, poll_interval=0.01)
+        own.beat(name)
+        while (job := own.claim(name)) is not None:
+            with lock:
+                claimed.append(job['id'])
+
+    threads = [threading.Thread(target=worker, args=(f'worker-{i}',)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(ids)
+
+
+def test_only_jobs_of_dead_workers_are_requeued(queue):
+    slow = queue.submit('prompt', 'a', {})
+    lost = queue.submit('prompt', 'b', {})
+    queue.beat('alive')
+    queue.beat('dead')
+    queue.claim('alive')
+    queue.claim('dead')
+
+    time.sleep(0.3)
+    queue.beat('alive')
+    queue.beat('rescuer')
+    assert queue.claim('rescuer')['id'] == lost
+    assert queue.get(slow)['worker'] == 'alive'
+    assert queue.claim('rescuer') is None
+
+    # The dead worker's late result is ignored.
+    assert not queue.finish(lost, 'dead', result={'from': 'dead'})
+    assert queue.finish(lost, 'rescuer', result={'from': 'rescuer'})
+    assert queue.wait(lost) == {'from': 'rescuer'}
+
+
+def test_wait_gives_up_without_workers(queue):
+    job_id = queue.submit('prompt', 'a', {})
+    with pytest.raises(TimeoutError, match='No workers'):
+        queue.wait(job_id)
+    assert queue.get(job_id)['status'] == 'cancelled'
+    # Cancelled jobs are never claimed.
+    queue.beat('late')
+    assert queue.claim('late') is None
+
+
+def test_wait_times_out_on_running_jobs(queue):
+    job_id = queue.submit('prompt', 'a', {})
+    queue.beat('worker')
+    queue.claim('worker')
+    with pytest.raises(TimeoutError, match='Timed out'):
+        queue.wait(job_id, timeout=0.05)
+    assert queue.get(job_id)['status'] == 'running'
+
+
+def test_failed_jobs_raise(queue):
+    from stories.jobs import JobFailed
+
+    job_id = queue.submit('prompt', 'a', {})
+    queue.beat('worker')
+    queue.claim('worker')
+    queue.finish(job_id, 'worker', error='RunError: failed')
+    with pytest.raises(JobFailed, match='RunError'):
+        queue.wait(job_id)
+
+
+def test_session_delta_holds_only_changes():
+    original = Session('s1', theme='space')
+    original.entities.add(Entity('character', 'Alice', 'curious'))
+    original.entities.add(Entity('character', 'Bob', 'quiet'))
+    original.assets.add(Asset('m1', 'narration', 'opus'))
+    before = original.as_dict
+
+    session = Session('s1').load(before)
+    session.guidelines = 'short chapters'
+    session.entities['Bob'].desc = 'loud'
+    session.entities.add(Entity('location', 'Mars', 'red'))
+    session.assets.add(Asset('m2', 'visualization', 'png'))
+
+    delta = session_delta(before, session)
+    assert delta['config'] == {'guidelines': 'short chapters'}
+    assert [entity['name'] for entity in delta['entities']] == ['Bob', 'Mars']
+    assert delta['assets'] == [Asset('m2', 'visualization', 'png').as_dict]
+    assert delta['messages'] == []
+
+
+def test_checkpoints_survive_a_requeue(queue):
+    job_id = queue.submit('prompt', 'a', {'content': 'Begin'})
+    queue.beat('dead')
+    queue.claim('dead')
+    assert queue.checkpoint(job_id, 'dead', {'message_id': 'msg-1', 'run_id': 'run-1'})
+
+    time.sleep(0.3)
+    queue.beat('rescuer')
+    job = queue.claim('rescuer')
+    assert job['progress'] == {'message_id': 'msg-1', 'run_id': 'run-1'}
+    # The dead worker can no longer move the job along.
+    assert not queue.checkpoint(job_id, 'dead', {})
+
+
+def worker_job(stories, session_id: str, progress: dict = None) -> dict:
+    return {
+        'id': 'job-1',
+        'kind': 'prompt',
+        'session_id': session_id,
+        'payload': {'session': stories.sessions[session_id].as_dict, 'storybotid': stories.storybotid, 'content': 'Begin'},
+        'progress': progress or {},
+    }
+
+
+@pytest.fixture
+def worker(stories, client):
+    ''' A worker's InteractiveStories instance, sharing the fake client with the UI's. '''
+    from stories.app import InteractiveStories
+
+    return InteractiveStories(client=client, persist=False)
+
+
+def test_prompt_jobs_checkpoint_their_message_and_run(stories, client, worker):
+    checkpoints = []
+    run_job(worker, worker_job(stories, stories.activesess), lambda progress: checkpoints.append(dict(progress)))
+
+    message_id, = [message.id for message in client.threads[stories.activesess] if message.role == 'user']
+    assert checkpoints == [{'message_id': message_id}, {'message_id': message_id, 'run_id': next(iter(client.runs))}]
+
+
+@pytest.mark.parametrize('recorded', [('message_id', 'run_id'), ('message_id',)])
+def test_requeued_prompt_jobs_resume_the_run(stories, client, worker, recorded):
+    session_id = stories.activesess
+    # The first worker posted the prompt and started the run, then stopped.
+    client.script.append([('set_entity_bio', {'type': 'character', 'name': 'Alice', 'desc': 'curious'})])
+    message = client.create_message(session_id, 'user', 'Begin', {'type': 'prompt'})
+    run = client.create_run(session_id, stories.storybotid)
+    progress = {'message_id': message.id, 'run_id': run.id}
+
+    delta = run_job(worker, worker_job(stories, session_id, {key: progress[key] for key in recorded}))
+
+    assert [message.content[0].text.value for message in client.threads[session_id]] == ['Begin', 'The end.']
+    assert len(client.runs) == 1
+    assert [entity['name'] for entity in delta['entities']] == ['Alice']
+    assert [message['text'] for message in delta['messages']] == ['Begin', 'The end.']
+
+
+def test_run_job_merges_worker_changes(stories, client, worker, database):
+    session_id = stories.activesess
+    stories.jobs = JobQueue(database, poll_interval=0.01, wait_timeout=5)
+    stories.set_entity_bio('character', 'Bob', 'quiet', session_id=session_id)
+    client.script.append([
+        ('set_story_config', {'theme': 'space', 'guidelines': 'short chapters'}),
+        ('set_entity_bio', {'type': 'character', 'name': 'Alice', 'desc': 'curious'}),
+    ])
+
+    def work():
+        queue = JobQueue(database, poll_interval=0.01)
+        queue.beat('worker')
+        while (job := queue.claim('worker')) is None:
+            time.sleep(0.01)
+        queue.finish(job['id'], 'worker', result=run_job(worker, job))
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    stories.run_job('prompt', session_id, content='Begin')
+    thread.join()
+
+    session = stories.sessions[session_id]
+    assert (session.theme, session.guidelines) == ('space', 'short chapters')
+    assert [entity.name for entity in session.entities] == ['Bob', 'Alice']
+    assert [message.text for message in session.messages] == ['Begin', 'The end.']
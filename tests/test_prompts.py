@@ -0,0 +1,42 @@
+from stories.prompts import PromptQueue
+
+
+def test_first_put_drains():
+    queue = PromptQueue()
+    assert queue.put('one')
+    assert queue.busy
+    assert not queue.put('two')
+
+
+def test_queued_prompts_are_coalesced():
+    queue = PromptQueue(max_batch=2, separator=' | ')
+    queue.put('one')
+    queue.put('two')
+    queue.put('three')
+    assert queue.take() == 'one | two'
+    assert queue.take() == 'three'
+    assert queue.take() is None
+    assert not queue.busy
+    # The next put starts draining again.
+    assert queue.put('four')
+
+
+def test_without_coalescing_prompts_run_one_at_a_time():
+    queue = PromptQueue(coalesce=False)
+    queue.put('one')
+    queue.put('two')
+    assert queue.take() == 'one'
+    assert queue.take() == 'two'
+
+
+def test_fail_drops_queued_prompts():
+    queue = PromptQueue()
+    queue.put('one')
+    queue.put('two')
+    error = RuntimeError('run failed')
+    assert queue.fail(error) == ['one', 'two']
+    assert (queue.error, queue.dropped, len(queue)) == (error, ['one', 'two'], 0)
+    assert queue.wait(0)
+    # The next prompt starts on its own.
+    assert queue.put('three')
+    assert queue.take() == 'three'
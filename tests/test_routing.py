@@ -0,0 +1,54 @@
+import pytest
+
+from stories.app import Session
+from stories.routing import Router
+
+
+CONFIG = {
+    'tiers': {
+        'fast': {'model': 'gpt-3.5-turbo-1106'},
+        'quality': {'model': 'gpt-4-1106-preview', 'additional_instructions': 'Take your time.'},
+    },
+    'routing': [
+        {'tier': 'fast', 'setup': True},
+        {'tier': 'fast', 'max_words': 4},
+        {'tier': 'quality', 'pattern': r'\bchapter\b'},
+    ],
+}
+
+
+@pytest.fixture
+def configured():
+    return Session('s1', theme='space', guidelines='short')
+
+
+def test_setup_prompts_use_the_fast_tier():
+    assert Router.from_config(CONFIG).route(Session('s1'), 'Let us begin a long and winding story').name == 'fast'
+
+
+def test_rules_apply_in_order(configured):
+    router = Router.from_config(CONFIG)
+    assert router.route(configured, 'Open the door').name == 'fast'
+    assert router.route(configured, 'Write the next chapter of the story').name == 'quality'
+
+
+def test_unmatched_prompts_keep_the_assistant_model(configured):
+    assert Router.from_config(CONFIG).route(configured, 'Describe the spaceship in detail') is None
+
+
+def test_default_tier(configured):
+    router = Router.from_config({**CONFIG, 'default_tier': 'quality'})
+    assert router.route(configured, 'Describe the spaceship in detail').name == 'quality'
+
+
+def test_session_tier_takes_precedence(configured):
+    configured.tier = 'quality'
+    tier = Router.from_config(CONFIG).route(configured, 'Go')
+    assert tier.run_args() == {'model': 'gpt-4-1106-preview', 'additional_instructions': 'Take your time.'}
+
+
+def test_unknown_tiers_are_rejected():
+    with pytest.raises(ValueError, match='unknown tier'):
+        Router.from_config({**CONFIG, 'routing': [{'tier': 'turbo'}]})
+    with pytest.raises(ValueError, match='default tier'):
+        Router.from_config({**CONFIG, 'default_tier': 'turbo'})
@@ -0,0 +1,94 @@
+import pytest
+
+from stories.schema import ValidationError, compile_schema, compile_tools
+
+
+ENTITY = {
+    'type': 'object',
+    'properties': {
+        'type': {'type': 'string', 'enum': ['character', 'location']},
+        'name': {'type': 'string'},
+        'age': {'type': 'integer'},
+        'height': {'type': 'number'},
+        'alive': {'type': 'boolean'},
+        'aliases': {'type': 'array', 'items': {'type': 'string'}},
+    },
+    'required': ['type', 'name'],
+}
+
+
+@pytest.fixture
+def validate():
+    return compile_schema(ENTITY)
+
+
+def test_valid_values_pass_through(validate):
+    value = {'type': 'character', 'name': 'Alice', 'age': 7, 'height': 1.2, 'alive': True, 'aliases': ['Al']}
+    assert validate(value, 'arguments') == value
+
+
+def test_close_values_are_coerced(validate):
+    value = validate({
+        'type': ' Character ',
+        'name': 42,
+        'age': '7',
+        'height': '1.5',
+        'alive': 'TRUE',
+        'aliases': 'Al',
+    }, 'arguments')
+    assert value == {'type': 'character', 'name': '42', 'age': 7, 'height': 1.5, 'alive': True, 'aliases': ['Al']}
+
+
+def test_json_encoded_containers_are_decoded(validate):
+    value = validate('{"type": "location", "name": "Wonderland", "aliases": "[\\"WL\\"]"}', 'arguments')
+    assert value == {'type': 'location', 'name': 'Wonderland', 'aliases': ['WL']}
+
+
+def test_nulls_are_dropped(validate):
+    assert validate({'type': 'character', 'name': 'Alice', 'age': None}, 'arguments') == {'type': 'character', 'name': 'Alice'}
+
+
+def test_integral_floats_are_integers():
+    assert compile_schema({'type': 'integer'})(3.0, 'n') == 3
+    with pytest.raises(ValidationError):
+        compile_schema({'type': 'integer'})(3.5, 'n')
+
+
+def test_booleans_are_not_numbers():
+    with pytest.raises(ValidationError, match='expected an integer'):
+        compile_schema({'type': 'integer'})(True, 'n')
+    with pytest.raises(ValidationError, match='expected a number'):
+        compile_schema({'type': 'number'})(False, 'n')
+
+
+def test_errors_are_collected_with_paths(validate):
+    with pytest.raises(ValidationError) as e:
+        validate({'type': 'planet', 'age': 'old', 'aliases': ['Al', ['x']], 'colour': 'red'}, 'arguments')
+    assert sorted(e.value.errors) == sorted([
+        'arguments.name: is required',
+        'arguments.type: expected one of: character, location',
+        'arguments.age: expected an integer',
+        'arguments.colour: is not a known property',
+    ])
+
+
+def test_array_item_errors_include_the_index():
+    validate = compile_schema({'type': 'array', 'items': {'type': 'integer'}})
+    with pytest.raises(ValidationError) as e:
+        validate([1, 'two', 3, 'four'], 'ids')
+    assert e.value.errors == ['ids[1]: expected an integer', 'ids[3]: expected an integer']
+
+
+def test_non_objects_are_rejected(validate):
+    with pytest.raises(ValidationError, match='expected an object'):
+        validate(['Alice'], 'arguments')
+
+
+def test_compile_tools_skips_non_function_tools():
+    validators = compile_tools([
+        {'type': 'code_interpreter'},
+        {'type': 'function', 'function': {'name': 'get_entity_names'}},
+        {'type': 'function', 'function': {'name': 'set_entity_bio', 'parameters': ENTITY}},
+    ])
+    assert sorted(validators) == ['get_entity_names', 'set_entity_bio']
+    assert validators['get_entity_names']({}, 'arguments') == {}
@@ -0,0 +1,47 @@
+import sys
+
+import pytest
+
+from stories import resolve_file
+from stories.app import InteractiveStories
+from stories.transport import Transport
+
+
+@pytest.fixture(autouse=True)
+def api_key(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+
+
+def test_profiles_share_pools_with_their_own_timeouts():
+    transport = Transport(
+        pools={'api': {'max_connections': 7}},
+        timeouts={'polling': {'read': 2.0}, 'generation': {'read': 90.0}},
+    )
+    api, polling, generation = (transport.client(profile) for profile in ('api', 'polling', 'generation'))
+
+    assert api._client is polling._client is transport.http_clients['api']
+    assert generation._client is transport.http_clients['media']
+    assert (polling.timeout.read, generation.timeout.read, api.timeout.read) == (2.0, 90.0, 60.0)
+    # Retries are left to the request governor.
+    assert api.max_retries == 0
+    transport.close()
+
+
+def test_shared_transports_are_reused_per_config():
+    first = Transport.shared(timeouts={'api': {'read': 11.0}})
+    assert Transport.shared(timeouts={'api': {'read': 11.0}}) is first
+    assert Transport.shared(timeouts={'api': {'read': 12.0}}) is not first
+
+
+def test_http2_falls_back_when_h2_is_missing(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'h2', None)
+    transport = Transport(http2=True)
+    assert transport.http2_requested and not transport.http2
+
+    conf_file = tmp_path / 'bots.toml'
+    config = open(resolve_file('config/bots.toml')).read()
+    conf_file.write_text(config.replace('http2 = false', 'http2 = true'))
+    monkeypatch.chdir(tmp_path)
+
+    stories = InteractiveStories(conf_file=str(conf_file))
+    assert 'HTTP/2 requested but the h2 package is not installed. Falling back to HTTP/1.1.' in stories.action_log
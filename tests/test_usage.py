@@ -0,0 +1,73 @@
+import pytest
+
+from stories.usage import BudgetExceeded, UsageLedger
+
+
+PRICES = {
+    'gpt-4': {'prompt': 0.01, 'completion': 0.03},
+    'dall-e-3': {'image': 0.04},
+    'tts-1': {'characters': 0.015},
+}
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = UsageLedger(str(tmp_path / 'usage.db'), PRICES, {
+        'session_soft': 1.0,
+        'session_hard': 2.0,
+        'user_daily_soft': 3.0,
+        'user_daily_hard': 4.0,
+    })
+    yield ledger
+    ledger.close()
+
+
+def test_costs(ledger):
+    assert ledger.record('s1', 'a', 'run', 'gpt-4', prompt_tokens=1000, completion_tokens=1000) == pytest.approx(0.04)
+    assert ledger.record('s1', 'a', 'image', 'dall-e-3', units=2) == pytest.approx(0.08)
+    assert ledger.record('s1', 'a', 'tts', 'tts-1', units=2000) == pytest.approx(0.03)
+    assert ledger.record('s1', 'a', 'run', 'unpriced', prompt_tokens=1000) == 0
+
+
+def test_totals_and_breakdown(ledger):
+    ledger.record('s1', 'a', 'run', 'gpt-4', prompt_tokens=100, completion_tokens=10)
+    ledger.record('s1', 'a', 'run', 'gpt-4', prompt_tokens=100, completion_tokens=10)
+    ledger.record('s2', 'b', 'image', 'dall-e-3', units=1)
+
+    totals = ledger.totals(session_id='s1')
+    assert (totals['events'], totals['prompt_tokens'], totals['completion_tokens']) == (2, 200, 20)
+    assert ledger.totals()['events'] == 3
+    assert [row['user_id'] for row in ledger.breakdown()] == ['b', 'a']
+
+    with pytest.raises(ValueError):
+        ledger.breakdown(group_by='cost; DROP TABLE usage_daily')
+
+
+def test_session_budgets(ledger):
+    assert ledger.check_budget('s1') == 'ok'
+    ledger.record('s1', None, 'image', 'dall-e-3', units=25)
+    assert ledger.check_budget('s1') == 'downgrade'
+    ledger.record('s1', None, 'image', 'dall-e-3', units=25)
+    with pytest.raises(BudgetExceeded, match='session budget'):
+        ledger.check_budget('s1')
+
+
+def test_user_budgets_span_sessions(ledger):
+    for session_id in ('s1', 's2', 's3', 's4', 's5'):
+        ledger.record(session_id, 'a', 'image', 'dall-e-3', units=20)
+    with pytest.raises(BudgetExceeded, match='user daily budget'):
+        ledger.check_budget('s6', 'a')
+    assert ledger.check_budget('s6', 'b') == 'ok'
+
+
+def test_anonymous_sessions_dont_share_a_user_budget(ledger):
+    for session_id in ('s1', 's2', 's3', 's4', 's5'):
+        ledger.record(session_id, None, 'image', 'dall-e-3', units=20)
+    assert ledger.check_budget('s6') == 'ok'
+
+
+def test_images_are_priced_by_variant(ledger):
+    ledger.prices['dall-e-3/hd/1792x1024'] = {'image': 0.12}
+    assert ledger.record('s1', 'a', 'image', 'dall-e-3/hd/1792x1024', units=1) == pytest.approx(0.12)
+    # Unlisted variants fall back to the model's price.
+    assert ledger.record('s1', 'a', 'image', 'dall-e-3/standard/1024x1024', units=1) == pytest.approx(0.04)
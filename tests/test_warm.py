@@ -0,0 +1,57 @@
+from itertools import count
+import time
+from types import SimpleNamespace
+
+from stories.warm import WarmThreads
+
+
+class FakeAssistants:
+    def __init__(self, failures: int = 0) -> None:
+        self.ids = count()
+        self.failures = failures
+        self.threads: set[str] = set()
+
+    def add_thread(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('refused')
+        thread_id = f'thread-{next(self.ids)}'
+        self.threads.add(thread_id)
+        return SimpleNamespace(id=thread_id)
+
+    def delete_thread(self, thread_id: str):
+        self.threads.remove(thread_id)
+        return True
+
+
+def wait_for(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_take_refill_and_close():
+    assistants = FakeAssistants()
+    pool = WarmThreads(assistants, size=2, refill_interval=5.0)
+    assert pool.take() is None
+
+    pool.start()
+    wait_for(lambda: len(pool) == 2)
+    assert pool.take() == 'thread-0'
+    # Taking a thread wakes the worker to replace it.
+    wait_for(lambda: len(pool) == 2)
+
+    pool.close()
+    # Only the thread handed out is left.
+    assert assistants.threads == {'thread-0'}
+    assert pool.take() is None
+
+
+def test_failed_refills_are_logged_and_retried():
+    log = []
+    pool = WarmThreads(FakeAssistants(failures=1), size=1, retry_interval=0.01, log=log.append)
+    pool.start()
+    wait_for(lambda: len(pool) == 1)
+    pool.close()
+    assert log == ['Failed to refill warm threads: refused']